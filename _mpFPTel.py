@@ -27,17 +27,25 @@ Using:
     - terminal:
         - Implicit CR
         - Implicit LF
-        - Local Echo: Force On
-        - Local line editing: Force On 
+        - Local Echo: Force Off (the board echoes what is typed)
+        - Local line editing: Force Off (keys go to the board as typed)
         - Keyboard = Linux
-    
+    Lines that start with '%' are for the server itself, e.g. '%stats'.
+    Every folder has a hidden file '.bundle.tar': download it for a backup of everything
+    below the folder, upload a tar file to it to unpack it there, in one go.
+
 """
 import _thread as thread
 import telnet
 import pyftpdlib
 from logging import NOTSET, DEBUG, INFO, WARNING, ERROR, FATAL
-from mpFTP import AnonAuthorizer, MPFS, MPFTPHandler, MPFTPServer
+from mpFTP import AnonAuthorizer, MPFS, MPFTPHandler, MPFTPServer, MPThreadedFTPServer
 from pyBoardEx import Microterm
+from boardPool import BoardPool
+from mpEmulator import EmulatedSerial
+from contentCache import ContentCache
+from boardMetrics import serveMetrics
+from tracing import startTracing
 
 # configuration:
 host_port           = ("localhost", 21)
@@ -46,9 +54,65 @@ host_port           = ("localhost", 21)
 # To do so, set USE_MICROPROCESSOR to False (default: True): 
 USE_MICROPROCESSOR  = True 
 
+# ... or be emulated in software (see mpEmulator), with a folder on this computer as the board's
+# file system, e.g. EMULATED_BOARD = "./emulatedBoard" (default: None):
+EMULATED_BOARD      = None
+
+# To save serial time and heap on the board, the file operations helpers can be stored on the 
+# board once, after which they are called by opcode (default: False):
+USE_BOARD_AGENT     = False
+
+# Serve every board that is attached instead of only the first one found; each board is then
+# a top-level folder (e.g. /COM3) and a Telnet session starts by selecting a board (default: False):
+USE_BOARD_POOL      = False
+
+# While FTP traffic is active, the board can stay in raw REPL mode instead of switching to
+# and fro for every call; it returns to the friendly REPL once Telnet needs it, or when idle:
+Microterm.keepRawRepl    = True
+Microterm.rawReplTimeout = 10  # seconds
+
+# File data is deflated on the wire where the firmware has the (u)zlib or deflate module and the
+# data compresses; reportTransfers prints the compression ratio and throughput of each transfer:
+Microterm.compressTransfers = True
+Microterm.reportTransfers   = False
+
+# On connecting, measure the link to choose the chunk size and, for boards of which the REPL is on 
+# a UART (e.g. ESP32), the highest baud rate that works. The result is remembered per port; the
+# board's UART returns to 115200 baud when the server stops (default: False):
+Microterm.autoCalibrate     = False
+
+# Uploaded .py files can be compiled to .mpy first by mpy-cross (if installed and of the board's
+# MicroPython version), so the board need not compile them on every import. Which files are, is
+# up to MpyCompiler.include and .exclude (boot.py and main.py are kept as source) (default: False):
+Microterm.compileUploads    = False
+
+# Files downloaded from the board are kept on this computer, so a client that fetches the same
+# file again is not transferred again while its size and mtime on the board are the same;
+# the board is asked for both (a round trip) before a file is served from what is kept, and
+# verifyContent also compares the hash the board computes. How much is kept, in memory and in an
+# optional spill folder, is up to ContentCache.budget, .spillFolder and .spillBudget (default: False):
+Microterm.cacheContent      = False
+Microterm.verifyContent     = False
+ContentCache.spillFolder    = None
+
+# Round trips, serial traffic and latencies per board operation are shown by the FTP command
+# 'SITE STATS' and the Telnet line '%stats'; they are also served for Prometheus to scrape at
+# http://localhost:<METRICS_PORT>/metrics, e.g. METRICS_PORT = 9100 (default: None):
+METRICS_PORT        = None
+
+# FTP clients often delete many files in a row; those deletions can be collected for this many
+# seconds and then sent to the board in one batch, e.g. 0.2. The client is told a file is deleted
+# before it is; a failure is then only reported on the console (default: 0, delete right away):
+MPFS.deleteDelay = 0
+
 # For even more debug information, let the file system's 'debug' to True (default: False)
 # Then every call to it's methods with be printed to the console:
-MPFS.debug = True
+MPFS.debug = False
+
+# To see where the time goes, record every FTP command, file system call, board call and serial
+# transfer as nested spans to a file in the Chrome trace format, e.g. TRACE_FILE = "mpFPTel.json"
+# (open it in chrome://tracing or https://ui.perfetto.dev). Written on exit (default: None):
+TRACE_FILE          = None
 
 # Set desired logging level by changing the index from the following set:
 loggingLevel        = [NOTSET, DEBUG, INFO, WARNING, ERROR, FATAL][1]
@@ -57,6 +121,8 @@ loggingLevel        = [NOTSET, DEBUG, INFO, WARNING, ERROR, FATAL][1]
 if __name__ == '__main__':
     
     pyftpdlib.log.config_logging(loggingLevel)
+    if MPFS.debug or TRACE_FILE is not None:
+        startTracing(TRACE_FILE, echo = MPFS.debug)
        
     authorizer          = AnonAuthorizer()     
     authorizer.add_anonymous("/", perm="elradfmw")
@@ -64,14 +130,34 @@ if __name__ == '__main__':
     handler             = MPFTPHandler if USE_MICROPROCESSOR else pyftpdlib.handlers.FTPHandler
     handler.authorizer  = authorizer
 
-    server = MPFTPServer(host_port, handler)
+    if USE_MICROPROCESSOR:
+        # every FTP connection has a thread of its own; Telnet runs its event loop in
+        # another thread, so neither waits for the other's board calls
+        server = MPThreadedFTPServer(host_port, handler)
+    else:
+        server = MPFTPServer(host_port, handler)
 
     if USE_MICROPROCESSOR:
-        board               = Microterm()
-        MPFS.board          = board
-        telnet.terminal     = board
+        if USE_BOARD_POOL:
+            pool            = BoardPool(useAgent = USE_BOARD_AGENT)
+            MPFS.pool       = pool
+            telnet.pool     = pool
+            boards          = pool
+        else:
+            transport       = None if EMULATED_BOARD is None else EmulatedSerial(EMULATED_BOARD)
+            board           = Microterm(useAgent = USE_BOARD_AGENT, transport = transport)
+            MPFS.board      = board
+            telnet.terminal = board
+            boards          = [board]
+        if METRICS_PORT is not None:
+            serveMetrics(boards, ("localhost", METRICS_PORT))
         telnet.whiteList    = server.allowedIP
         
         thread.start_new_thread(telnet.start, ())
-        
-    server.serve_forever()
\ No newline at end of file
+        try:
+            server.serve_forever()
+        finally:
+            for board in boards:
+                board.stop()
+    else:
+        server.serve_forever()
\ No newline at end of file
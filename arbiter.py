@@ -0,0 +1,125 @@
+from heapq import heappush, heappop
+from itertools import count
+from time import time
+import threading
+
+
+# priorities; a lower number is served first
+INTERACTIVE = 0     # Telnet lines and Ctrl-C
+COMMAND     = 1     # short board operations (stat, listing, rename, ...)
+BULK        = 2     # file transfers, which give way between chunks
+IDLE        = 3     # reading what the REPL prints by itself, when nobody else needs the board
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", COMMAND: "command", BULK: "bulk", IDLE: "idle"}
+
+
+
+class _Access(object):
+
+    def __init__(self, arbiter, priority):
+        self.arbiter    = arbiter
+        self.priority   = priority
+
+    def __enter__(self):
+        self.arbiter.acquire(self.priority)
+        return self.arbiter
+
+    def __exit__(self, *args):
+        self.arbiter.release()
+
+
+
+class BoardArbiter(object):
+    """
+    Grants access to the board (i.e. its serial port) to one thread at a time. A thread
+    may acquire repeatedly (re-entrant); waiting threads are served by priority and then
+    in order of arrival. The queue depth and waiting times are kept for inspection.
+    """
+
+    def __init__(self):
+        self.condition  = threading.Condition()
+        self.queue      = []
+        self.sequence   = count()
+        self.owner      = None
+        self.priority   = None
+        self.depth      = 0
+        self.maxDepth   = 0
+        self.waits      = dict([(p, [0, 0.0, 0.0]) for p in PRIORITY_NAMES])  # count, total, max
+
+
+    def access(self, priority = COMMAND):
+        """
+        Context manager: with arbiter.access(BULK): ...
+        """
+        return _Access(self, priority)
+
+
+    def _wait(self, priority):
+        entry = [priority, next(self.sequence), threading.get_ident()]
+        heappush(self.queue, entry)
+        self.maxDepth = max(self.maxDepth, len(self.queue))
+        start = time()
+        while self.owner is not None or self.queue[0] is not entry:
+            self.condition.wait()
+        heappop(self.queue)
+        waited = time() - start
+        stats = self.waits[priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2]  = max(stats[2], waited)
+        self.owner      = entry[2]
+        self.priority   = priority
+
+
+    def acquire(self, priority = COMMAND):
+        with self.condition:
+            if self.owner == threading.get_ident():
+                self.depth += 1
+                return
+            self._wait(priority)
+            self.depth = 1
+
+
+    def release(self):
+        with self.condition:
+            if self.owner != threading.get_ident():
+                raise RuntimeError("board access released by a thread that does not own it")
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                self.condition.notify_all()
+
+
+    def contended(self):
+        """
+        True if a thread with a higher priority than the owner is waiting.
+        """
+        with self.condition:
+            return len(self.queue) > 0 and self.queue[0][0] < self.priority
+
+
+    def yieldTo(self):
+        """
+        Preemption point: if a thread with a higher priority is waiting, let it go first
+        and then continue with the same access as before.
+        """
+        with self.condition:
+            if self.owner != threading.get_ident() or not self.contended():
+                return False
+            depth, priority = self.depth, self.priority
+            self.owner = None
+            self.condition.notify_all()
+            self._wait(priority)
+            self.depth = depth
+            return True
+
+
+    def metrics(self):
+        with self.condition:
+            result = {"queueDepth": len(self.queue), "maxQueueDepth": self.maxDepth}
+            for priority, (n, total, longest) in self.waits.items():
+                name = PRIORITY_NAMES[priority]
+                result["%sGrants" % name]       = n
+                result["%sMeanWait" % name]     = total / n if n else 0.0
+                result["%sMaxWait" % name]      = longest
+            return result
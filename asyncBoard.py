@@ -0,0 +1,29 @@
+from functools import partial
+import asyncio
+
+
+
+class AsyncBoard(object):
+    """
+    A board for code on an asyncio loop: every method returns a future instead of its result,
+    as the call runs on a worker thread, so the loop goes on while the board is busy. Who gets
+    the board first is up to its arbiter, as for any other thread.
+        info = yield from AsyncBoard(board).fileInfo("/main.py")
+    """
+
+    def __init__(self, board, loop = None, executor = None):
+        self.board      = board
+        self.loop       = loop
+        self.executor   = executor
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.board, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            loop = self.loop or asyncio.get_event_loop()
+            return loop.run_in_executor(self.executor, partial(attribute, *args, **kwargs))
+        call.__name__ = name
+        return call
@@ -0,0 +1,153 @@
+"""
+Benchmarks of the serial, FTP and Telnet paths against the board emulator (see mpEmulator),
+so that the effect of a change can be measured without hardware, e.g. in CI:
+
+    python benchmark.py --baud 115200 --latency 0.002 --json results.json
+
+Reported per case: the time taken, the throughput where it applies, the number of commands
+executed on the board (i.e. round trips) and the number of soft resets.
+"""
+from contextlib import redirect_stdout
+from time import time
+import argparse
+import ftplib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from mpEmulator import EmulatedSerial
+from pyBoardEx import Microterm
+from mpFTP import AnonAuthorizer, MPFS, MPFTPHandler, MPFTPServer
+from pyftpdlib.log import config_logging
+
+
+
+class Benchmark(object):
+
+    def __init__(self, board, repeat = 3):
+        self.board      = board
+        self.emulator   = board.serial.board
+        self.repeat     = repeat
+        self.results    = []
+
+
+    def measure(self, name, action, size = None):
+        """
+        Run action repeat times and keep the mean time and round trips of a run.
+        """
+        commands, resets = self.emulator.commands, self.emulator.resets
+        start = time()
+        for _ in range(self.repeat):
+            action()
+        seconds = (time() - start) / self.repeat
+        result  = {"name": name, "seconds": seconds,
+                   "bytesPerSecond": size / seconds if size and seconds else None,
+                   "commands": (self.emulator.commands - commands) / self.repeat,
+                   "resets": (self.emulator.resets - resets) / self.repeat}
+        self.results.append(result)
+        return result
+
+
+    def serial(self, sizes):
+        board = self.board
+        for size in sizes:
+            for kind, data in (("text", (b"print('hello world')  # some python source\n" * (size // 40 + 1))[:size]),
+                               ("random", os.urandom(size))):
+                name = "/bench_%s_%d" % (kind, size)
+                self.measure("put %s %d" % (kind, size), lambda: board.put(name, data), size)
+                self.measure("get %s %d" % (kind, size), lambda: board.get(name), size)
+        self.measure("ls /", self._ls)
+        self.measure("stat", lambda: board.fileInfo(name, getFresh = True))
+        self.measure("stat (cached)", lambda: board.fileInfo(name))
+
+
+    def _ls(self):
+        self.board.cache.clear()
+        return self.board.ls("/")
+
+
+    def ftp(self, sizes):
+        authorizer = AnonAuthorizer()
+        authorizer.add_anonymous("/", perm = "elradfmw")
+        MPFTPHandler.authorizer = authorizer
+        MPFS.board  = self.board
+        server      = MPFTPServer(("127.0.0.1", 0), MPFTPHandler)
+        threading.Thread(target = server.serve_forever, kwargs = {"handle_exit": False}, daemon = True).start()
+        client      = ftplib.FTP()
+        client.connect("127.0.0.1", server.address[1])
+        client.login()
+        client.voidcmd("TYPE I")
+        for size in sizes:
+            data = os.urandom(size)
+            self.measure("FTP STOR %d" % size, lambda: client.storbinary("STOR ftp.bin", io.BytesIO(data)), size)
+            self.measure("FTP RETR %d" % size, lambda: client.retrbinary("RETR ftp.bin", lambda d: None), size)
+        self.measure("FTP SIZE", lambda: client.size("ftp.bin"))
+        self.measure("FTP LIST", lambda: client.retrlines("LIST", lambda l: None))
+        client.quit()
+        server.close_all()
+
+
+    def telnet(self):
+        # what telnet.shell and its ConsolePump do for every line: pass the keys, then forward
+        # what the REPL prints until it prompts again
+        def line(keys, reply):
+            self.board.sendKeys(keys)
+            out, deadline = b"", time() + 2
+            while not out.endswith(reply):
+                if time() > deadline:
+                    raise RuntimeError("no prompt after Telnet keys %r: %r" % (keys, out))
+                out += self.board.readConsole() or b""
+        line(b"\r", b">>> ")   # a prompt to begin with
+        self.measure("Telnet line", lambda: line(b"1 + 1\r", b"2\r\n>>> "))
+
+
+    def report(self):
+        print("%-24s %10s %12s %9s %7s" % ("case", "ms", "bytes/s", "commands", "resets"))
+        for r in self.results:
+            print("%-24s %10.1f %12s %9.1f %7.1f" % (r["name"], r["seconds"] * 1000,
+                  "" if r["bytesPerSecond"] is None else "%.0f" % r["bytesPerSecond"], r["commands"], r["resets"]))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark file transfers against the board emulator.")
+    parser.add_argument("--baud", type = int, default = 115200, help = "baud rate of the emulated link (0: unlimited)")
+    parser.add_argument("--latency", type = float, default = 0.002, help = "seconds per transfer, each direction")
+    parser.add_argument("--heap", type = int, default = 100000, help = "heap size of the emulated board")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [1024, 16384, 65536])
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--agent", action = "store_true", help = "call the helpers through the board agent")
+    parser.add_argument("--compress", action = "store_true", help = "compress transfers")
+    parser.add_argument("--keep-raw-repl", action = "store_true", help = "stay in raw REPL between calls")
+    parser.add_argument("--no-raw-paste", action = "store_true", help = "send code the classic way, without flow control")
+    parser.add_argument("--json", help = "also write the results to this file")
+    args = parser.parse_args()
+
+    config_logging(logging.WARNING)
+    Microterm.compressTransfers = args.compress
+    Microterm.keepRawRepl       = args.keep_raw_repl
+    Microterm.useRawPaste       = not args.no_raw_paste
+    root = tempfile.mkdtemp(prefix = "mpbench")
+    try:
+        transport = EmulatedSerial(root, baudrate = args.baud or None, latency = args.latency, heapSize = args.heap)
+        board     = Microterm(args.baud, silent = True, useAgent = args.agent, transport = transport)
+        bench     = Benchmark(board, args.repeat)
+        with redirect_stdout(io.StringIO()):    # the diagnostics of the FTP file system
+            bench.serial(args.sizes)
+            bench.ftp(args.sizes)
+            bench.telnet()
+        bench.report()
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"settings": vars(args), "results": bench.results}, f, indent = 1)
+    finally:
+        shutil.rmtree(root, ignore_errors = True)
+
+
+
+if __name__ == '__main__':
+    main()
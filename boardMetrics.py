@@ -0,0 +1,270 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import time
+import threading
+
+
+LATENCY_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)   # seconds
+
+# the Prometheus metric families of a board's figures (see BoardMetrics.snapshot): name, type, key
+PROMETHEUS_FAMILIES = (("round_trips_total", "counter", "roundTrips"),
+                       ("serial_bytes_sent_total", "counter", "bytesSent"),
+                       ("serial_bytes_received_total", "counter", "bytesReceived"),
+                       ("serial_wait_seconds_total", "counter", "serialWait"),
+                       ("raw_repl_switches_total", "counter", "replSwitches"),
+                       ("raw_repl_switches_saved_total", "counter", "replSwitchesSaved"),
+                       ("mpy_files_compiled_total", "counter", "filesCompiled"),
+                       ("mpy_bytes_saved_total", "counter", "bytesSaved"),
+                       ("content_cache_hits_total", "counter", "contentHits"),
+                       ("content_cache_misses_total", "counter", "contentMisses"),
+                       ("content_cache_bytes", "gauge", "contentBytes"),
+                       ("content_cache_spilled_bytes", "gauge", "contentSpilled"),
+                       ("queue_depth", "gauge", "queueDepth"))
+
+
+
+class LatencyHistogram(object):
+    """
+    Counts of observed durations per bucket (upper bounds in seconds, cumulative as in Prometheus).
+    """
+
+    def __init__(self, bounds = LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum    = 0.0
+        self.count  = 0
+
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(self.bounds) and seconds > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum       += seconds
+        self.count     += 1
+
+
+    def cumulative(self):
+        total, result = 0, []
+        for bound, n in zip(list(self.bounds) + ["+Inf"], self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+
+
+class _Timing(object):
+
+    def __init__(self, metrics, operation):
+        self.metrics    = metrics
+        self.operation  = operation
+
+    def __enter__(self):
+        self.start = time()
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.operation, time() - self.start)
+
+
+
+class BoardMetrics(object):
+    """
+    What a board is doing: round trips (commands executed), bytes over the serial port,
+    the time spent waiting for the port and a latency histogram per operation.
+    """
+
+    def __init__(self):
+        self.lock           = threading.Lock()
+        self.started        = time()
+        self.roundTrips     = 0
+        self.bytesSent      = 0
+        self.bytesReceived  = 0
+        self.serialWait     = 0.0
+        self.operations     = {}
+        self.filesCompiled  = 0     # by mpy-cross, see mpyCross
+        self.bytesSaved     = 0     # ... and the bytes that saved on the wire
+
+
+    def timing(self, operation):
+        """
+        Context manager: with metrics.timing("getFile"): ...
+        """
+        return _Timing(self, operation)
+
+
+    def observe(self, operation, seconds):
+        with self.lock:
+            histogram = self.operations.get(operation)
+            if histogram is None:
+                histogram = self.operations[operation] = LatencyHistogram()
+            histogram.observe(seconds)
+
+
+    def compiled(self, bytesSaved):
+        with self.lock:
+            self.filesCompiled += 1
+            self.bytesSaved    += bytesSaved
+
+
+    def snapshot(self, board):
+        """
+        All figures of board as a dict, those of its arbiter (see arbiter.metrics()) and content
+        cache (see contentCache) included.
+        """
+        with self.lock:
+            result = {"uptime": time() - self.started, "roundTrips": self.roundTrips,
+                      "bytesSent": self.bytesSent, "bytesReceived": self.bytesReceived,
+                      "serialWait": self.serialWait, "replSwitches": board.replSwitches,
+                      "filesCompiled": self.filesCompiled, "bytesSaved": self.bytesSaved,
+                      "replSwitchesSaved": board.replSwitchesSaved,
+                      "operations": dict([(name, (h.count, h.sum, h.cumulative()))
+                                          for name, h in sorted(self.operations.items())])}
+        result.update(board.arbiter.metrics())
+        result.update(board.contentCache.metrics())
+        return result
+
+
+    def report(self, board):
+        """
+        The figures as lines of text, for people.
+        """
+        s = self.snapshot(board)
+        lines = ["board %s, up %.0f s" % (board.name, s["uptime"]),
+                 "round trips      : %d" % s["roundTrips"],
+                 "bytes sent       : %d" % s["bytesSent"],
+                 "bytes received   : %d" % s["bytesReceived"],
+                 "serial wait      : %.3f s" % s["serialWait"],
+                 "raw REPL switches: %d (%d saved)" % (s["replSwitches"], s["replSwitchesSaved"]),
+                 "queue depth      : %d (max %d)" % (s["queueDepth"], s["maxQueueDepth"]),
+                 "mpy-cross        : %d files, %d bytes saved" % (s["filesCompiled"], s["bytesSaved"]),
+                 "content cache    : %d hits, %d misses, %d bytes kept (%d spilled)" %
+                 (s["contentHits"], s["contentMisses"], s["contentBytes"], s["contentSpilled"]),
+                 "%-17s %7s %10s %10s" % ("operation", "count", "mean ms", "total s")]
+        for name, (count, total, _) in s["operations"].items():
+            lines.append("%-17s %7d %10.1f %10.3f" % (name, count, 1000 * total / count, total))
+        return lines
+
+
+
+class MeteredSerial(object):
+    """
+    Wraps the serial port of a board to count the bytes that pass and the time spent waiting
+    for them; anything else goes to the port itself.
+    """
+
+    def __init__(self, port, metrics):
+        self.__dict__["port"]       = port
+        self.__dict__["metrics"]    = metrics
+        self.__dict__["depth"]      = 0
+
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+
+    def __setattr__(self, name, value):
+        setattr(self.port, name, value)
+
+
+    def write(self, data):
+        self.metrics.bytesSent += len(data)
+        return self.port.write(data)
+
+
+    def read(self, size = 1):
+        start   = time()
+        data    = self.port.read(size)
+        self.metrics.bytesReceived += len(data)
+        if self.depth == 0:
+            self.metrics.serialWait += time() - start
+        return data
+
+
+    def readIdle(self, size = 1):
+        """
+        Read output that the board may or may not send by itself (see Microterm.readConsole);
+        waiting for it is not waiting for the board.
+        """
+        data = self.port.read(size)
+        self.metrics.bytesReceived += len(data)
+        return data
+
+
+    def waiting(self):
+        """
+        Context manager to account for a wait of which reads are a part (see PyBoardEx.read_until).
+        """
+        return _Waiting(self)
+
+
+
+class _Waiting(object):
+
+    def __init__(self, serial):
+        self.serial = serial
+
+    def __enter__(self):
+        self.start = time()
+        self.serial.__dict__["depth"] += 1
+
+    def __exit__(self, *args):
+        self.serial.__dict__["depth"] -= 1
+        if self.serial.depth == 0:
+            self.serial.metrics.serialWait += time() - self.start
+
+
+
+def prometheus(boards):
+    """
+    The figures of boards in the Prometheus text format: every metric family once, with a
+    sample per board (labelled by its name).
+    """
+    snapshots   = [('board="%s"' % board.name, board.metrics.snapshot(board)) for board in boards]
+    lines       = []
+    for name, kind, key in PROMETHEUS_FAMILIES:
+        lines.append("# TYPE mpfptel_%s %s" % (name, kind))
+        lines += ["mpfptel_%s{%s} %s" % (name, label, s[key]) for label, s in snapshots]
+    lines.append("# TYPE mpfptel_operation_seconds histogram")
+    for label, s in snapshots:
+        for operation, (count, total, buckets) in s["operations"].items():
+            labels = '%s,operation="%s"' % (label, operation)
+            for bound, n in buckets:
+                lines.append('mpfptel_operation_seconds_bucket{%s,le="%s"} %d' % (labels, bound, n))
+            lines.append("mpfptel_operation_seconds_sum{%s} %f" % (labels, total))
+            lines.append("mpfptel_operation_seconds_count{%s} %d" % (labels, count))
+    return "\n".join(lines) + "\n"
+
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    boards = ()
+
+    def do_GET(self):
+        body = prometheus(self.boards).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, *args):
+        pass
+
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+def serveMetrics(boards, address = ("127.0.0.1", 9100)):
+    """
+    Serve the metrics of boards (a list, or a BoardPool) over HTTP, for Prometheus to scrape.
+    Return the server, which runs in a thread of its own.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"boards": boards})
+    server  = _ThreadingHTTPServer(address, handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
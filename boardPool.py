@@ -0,0 +1,63 @@
+import threading
+from pyBoardEx import Microterm, findBoards
+
+
+
+class BoardPool(object):
+    """
+    All attached boards, each by the name of its port (e.g. 'COM3' or 'ttyACM0').
+    Every board has its own serial arbiter, so different boards are used in parallel.
+    """
+
+    def __init__(self, speed = 115200, silent = False, useAgent = False, ports = None, boardClass = Microterm):
+        self.boards = {}
+        found       = findBoards(speed, ports)
+        busy        = [p[1:] for p in found if p.startswith('*')]
+        ports       = [p for p in found if not p.startswith('*')]
+        lock        = threading.Lock()
+
+        def connect(device):
+            try:
+                board = boardClass(speed, silent = silent, useAgent = useAgent, device = device)
+            except Exception as e:
+                print(device, e)
+                return
+            with lock:
+                self.boards[board.name] = board
+
+        # boards are opened side by side, as each one takes a while to answer
+        workers = [threading.Thread(target = connect, args = (p,)) for p in ports]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if not self.boards:
+            info = "no python board found on %s" % (", ".join(ports) or "any serial port")
+            if busy:
+                info += "; in use by another process: %s" % ", ".join(busy)
+            raise RuntimeError(info)
+
+
+    def __getitem__(self, name):
+        return self.boards[name]
+
+
+    def __iter__(self):
+        return iter([self.boards[name] for name in self.names()])
+
+
+    def __len__(self):
+        return len(self.boards)
+
+
+    def get(self, name, default = None):
+        return self.boards.get(name, default)
+
+
+    def names(self):
+        return sorted(self.boards)
+
+
+    def close(self):
+        for board in self:
+            board.stop()
@@ -0,0 +1,113 @@
+from binascii import crc32
+from hashlib import sha256
+import posixpath
+import json
+import os
+
+
+MANIFEST_NAME = ".mpsync.json"
+
+
+
+def localHash(fileName, like):
+    """
+    Hash of a local file, computed the same way as the board did for hash 'like'
+    (see operations.hashFiles).
+    """
+    algorithm = like.split(":")[0]
+    check = sha256() if algorithm == "sha256" else 0
+    with open(fileName, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            if algorithm == "sha256":
+                check.update(chunk)
+            else:
+                check = crc32(chunk, check)
+    if algorithm == "sha256":
+        return "sha256:" + check.hexdigest()
+    return "crc32:%08x" % (check & 0xffffffff)
+
+
+
+class Manifest(object):
+    """
+    What was true after the last sync of a local folder with the board: per file on the
+    board, its size and mtime on either side and its hash. A file of which neither
+    side's size or mtime changed since then, need not be compared or transferred.
+    """
+
+    def __init__(self, localRoot):
+        self.localRoot  = localRoot
+        self.fileName   = os.path.join(localRoot, MANIFEST_NAME)
+        try:
+            with open(self.fileName) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+
+    def save(self):
+        os.makedirs(self.localRoot, exist_ok = True)
+        with open(self.fileName, "w") as f:
+            json.dump(self.entries, f, indent = 1, sort_keys = True)
+
+
+    def localName(self, boardPath):
+        return os.path.join(self.localRoot, *[p for p in boardPath.split("/") if p])
+
+
+    def localFiles(self):
+        """
+        Return {boardPath: localName} for all files below the local root.
+        """
+        result = {}
+        for folder, _, files in os.walk(self.localRoot):
+            relative = os.path.relpath(folder, self.localRoot).replace(os.sep, "/")
+            for name in files:
+                boardPath = posixpath.normpath(posixpath.join("/", relative, name))
+                if boardPath != "/" + MANIFEST_NAME:
+                    result[boardPath] = os.path.join(folder, name)
+        return result
+
+
+    def boardKnown(self, boardPath, stats):
+        entry = self.entries.get(boardPath)
+        return entry is not None and stats is not None and \
+               (entry["size"], entry["mtime"]) == (stats[6], stats[8])
+
+
+    def localKnown(self, boardPath):
+        entry = self.entries.get(boardPath)
+        try:
+            stats = os.stat(self.localName(boardPath))
+        except OSError:
+            return False
+        return entry is not None and (entry["localSize"], entry["localMtime"]) == (stats.st_size, stats.st_mtime)
+
+
+    def hash(self, boardPath):
+        return self.entries[boardPath]["hash"]
+
+
+    def record(self, boardPath, stats, hashValue):
+        local = os.stat(self.localName(boardPath))
+        self.entries[boardPath] = {"size": stats[6], "mtime": stats[8], "hash": hashValue,
+                                   "localSize": local.st_size, "localMtime": local.st_mtime}
+
+
+    def forget(self, boardPath):
+        self.entries.pop(boardPath, None)
+
+
+
+class SyncReport(object):
+
+    def __init__(self):
+        self.copied     = []
+        self.unchanged  = 0
+        self.orphans    = []
+        self.deleted    = []
+
+
+    def __str__(self):
+        return "%d copied, %d unchanged, %d orphans (%d deleted)" % \
+               (len(self.copied), self.unchanged, len(self.orphans), len(self.deleted))
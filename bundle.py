@@ -0,0 +1,238 @@
+from mpError import PyboardErrorEx
+from time import time
+import tarfile
+import struct
+
+
+BUNDLE_NAME = ".bundle.tar"     # in any folder: the tar of everything below it (see MPFS.open)
+
+# A bundle is a stream of records, one per folder or file (see operations.getBundle):
+# type, length of the path, length of the content, path (relative to the folder) and content.
+RECORD      = struct.Struct(">cHI")
+FOLDER      = b'D'
+FILE        = b'F'
+APPEND      = b'A'      # more content of a file; of the previous one if the path is empty
+END         = b'E'
+
+
+
+def record(kind, path, data = b''):
+    path = path.encode("utf-8")
+    return RECORD.pack(kind, len(path), len(data)) + path + data
+
+
+def readExactly(stream, size):
+    """
+    Read size bytes from stream, of which a read may return less than asked for.
+    """
+    result = bytearray()
+    while len(result) < size:
+        chunk = stream.read(size - len(result))
+        if not chunk:
+            raise PyboardErrorEx("bundle %s incomplete" % getattr(stream, "name", ""))
+        result += chunk
+    return bytes(result)
+
+
+def readRecord(stream):
+    """
+    The next record of a bundle as (path, isDir, size), None at its end; the size bytes of
+    content are to be read from stream before the next record.
+    """
+    kind, pathLength, size = RECORD.unpack(readExactly(stream, RECORD.size))
+    if kind == END:
+        return None
+    if kind not in (FOLDER, FILE):
+        raise PyboardErrorEx("bundle %s corrupt: record type %r" % (getattr(stream, "name", ""), kind))
+    return readExactly(stream, pathLength).decode("utf-8"), kind == FOLDER, size
+
+
+def safePath(path):
+    """
+    path relative to the folder that a bundle is unpacked in, None if it points outside it.
+    """
+    parts = [p for p in path.replace('\\', '/').split('/') if p not in ("", ".")]
+    if not parts or ".." in parts:
+        return None
+    return "/".join(parts)
+
+
+
+class TarStream(object):
+    """
+    A bundle that is being received from the board (see BoardBundleReader) as a tar file,
+    produced while it is read. As the board does not send them, all entries get the current
+    time as their mtime.
+    """
+
+    def __init__(self, reader):
+        self.reader     = reader
+        self.name       = reader.name
+        self.pending    = bytearray()
+        self.remaining  = 0     # bytes of content of the current file still to be read
+        self.padding    = 0
+        self.ended      = False
+        self.closed     = False
+        self.time       = int(time())
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _produce(self, size):
+        if self.remaining:
+            chunk = self.reader.read(min(self.remaining, max(size, tarfile.BLOCKSIZE)))
+            if not chunk:
+                raise PyboardErrorEx("bundle %s incomplete" % self.name)
+            self.pending    += chunk
+            self.remaining  -= len(chunk)
+            if not self.remaining:
+                self.pending += bytes(self.padding)
+            return
+        entry = readRecord(self.reader)
+        if entry is None:
+            self.pending += bytes(2 * tarfile.BLOCKSIZE)
+            self.ended = True
+            return
+        path, isDir, size   = entry
+        info                = tarfile.TarInfo(path)
+        info.type           = tarfile.DIRTYPE if isDir else tarfile.REGTYPE
+        info.mode           = 0o755 if isDir else 0o644
+        info.size           = size
+        info.mtime          = self.time
+        self.pending       += info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+        self.remaining      = size
+        self.padding        = -size % tarfile.BLOCKSIZE
+
+
+    def read(self, size = -1):
+        while (size < 0 or len(self.pending) < size) and not self.ended:
+            self._produce(size)
+        size    = len(self.pending) if size < 0 else size
+        result  = bytes(self.pending[:size])
+        del self.pending[:size]
+        return result
+
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.reader.close()
+
+
+
+class TarUnpacker(object):
+    """
+    Takes a tar file apart while it is written to it, and has its folders and files unpacked
+    on the board by a BoardBundleWriter. Entries of other types (links, devices) are skipped,
+    as are those that would end up outside the folder.
+    """
+
+    def __init__(self, writer):
+        self.writer     = writer
+        self.name       = writer.name
+        self.pending    = bytearray()
+        self.remaining  = 0         # bytes of content of the current entry still to come
+        self.padding    = 0
+        self.target     = None      # where the content goes: writer, a long name or None
+        self.extended   = None      # type of the extended header being received
+        self.longName   = None      # from a GNU or pax extended header: the name of the next entry
+        self.ended      = False
+        self.closed     = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _content(self, data):
+        if self.target is self.writer:
+            self.writer.write(data)
+        elif self.target is not None:
+            self.target += data
+
+
+    def _header(self, block):
+        if block == bytes(tarfile.BLOCKSIZE):
+            self.ended = True
+            return
+        info            = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        self.remaining  = info.size
+        self.padding    = -info.size % tarfile.BLOCKSIZE
+        self.target     = None
+        if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+            self.target = bytearray()
+            self.extended = info.type
+            if not self.remaining:
+                self._extended()
+            return
+        name, self.longName = self.longName or info.name, None
+        path = safePath(name)
+        if path is None:
+            return
+        if info.isdir():
+            self.writer.mkdir(path)
+        elif info.isreg():
+            self.writer.create(path)
+            self.target = self.writer
+
+
+    def _extended(self):
+        data, self.target = bytes(self.target), None
+        if self.extended == tarfile.GNUTYPE_LONGNAME:
+            self.longName = data.rstrip(b'\0').decode("utf-8", "surrogateescape")
+            return
+        while data:
+            # pax records: "<length> <keyword>=<value>\n"
+            length  = int(data.split(b' ', 1)[0])
+            keyword, _, value = data[:length].split(b' ', 1)[1].partition(b'=')
+            if keyword == b'path':
+                self.longName = value[:-1].decode("utf-8", "surrogateescape")
+            data = data[length:]
+
+
+    def write(self, data):
+        self.pending += data
+        while not self.ended:
+            if self.remaining:
+                n = min(self.remaining, len(self.pending))
+                if not n:
+                    break
+                self._content(bytes(self.pending[:n]))
+                del self.pending[:n]
+                self.remaining -= n
+                if not self.remaining and isinstance(self.target, bytearray):
+                    self._extended()
+            elif self.padding:
+                n = min(self.padding, len(self.pending))
+                if not n:
+                    break
+                del self.pending[:n]
+                self.padding -= n
+            elif len(self.pending) >= tarfile.BLOCKSIZE:
+                block = bytes(self.pending[:tarfile.BLOCKSIZE])
+                del self.pending[:tarfile.BLOCKSIZE]
+                self._header(block)
+            else:
+                break
+        if self.ended:
+            del self.pending[:]
+        return len(data)
+
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        if self.remaining:
+            raise PyboardErrorEx("tar file %s incomplete" % self.name)
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from hashlib import sha1
+from io import BytesIO
+from statCache import StatCache
+import threading
+import tempfile
+import atexit
+import shutil
+import os
+
+
+
+class CachedFile(BytesIO):
+    """
+    The content of a file on the board as it was kept by the ContentCache, read like a BoardFileReader.
+    """
+
+    def __init__(self, fileName, data):
+        super().__init__(data)
+        self.name = fileName
+
+
+
+class ContentCache(object):
+    """
+    The content of files downloaded from a board, so that a file that did not change since is
+    not transferred again. An entry is kept by path, with a key of what the file was like on
+    the board (its size and mtime and, possibly, its hash); one of which the key differs is
+    gone. The least recently used entries make way once the memory budget is exceeded: to
+    the spill folder if there is one, else out. The cache may be shared by threads.
+    """
+
+    budget      = 8 * 1024 * 1024       # bytes of content in memory
+    maxFileSize = 1024 * 1024           # larger files are not kept
+    spillFolder = None                  # folder for what does not fit in memory, e.g. tempfile.gettempdir()
+    spillBudget = 64 * 1024 * 1024      # bytes of content in the spill folder
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.folder     = None
+        self.hits       = 0
+        self.misses     = 0
+        self.clear()
+
+
+    def clear(self):
+        with self.lock:
+            self.memory     = OrderedDict()     # path: (key, content)
+            self.disk       = OrderedDict()     # path: (key, file, size)
+            self.used       = 0
+            self.spilled    = 0
+            if self.folder is not None:
+                shutil.rmtree(self.folder, True)
+                self.folder = None
+
+
+    def get(self, path, key):
+        """
+        The content of path if it is kept with key, otherwise None.
+        """
+        path = StatCache.normalize(path)
+        with self.lock:
+            entry = self.memory.get(path)
+            if entry is not None and entry[0] == key:
+                self.memory.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            entry = self.disk.get(path)
+            if entry is not None and entry[0] == key:
+                with open(entry[1], "rb") as f:
+                    data = f.read()
+                self._keep(path, key, data)
+                self.hits += 1
+                return data
+            self._drop(path)
+            self.misses += 1
+            return None
+
+
+    def holds(self, path):
+        """
+        Whether content of path is kept, with whatever key.
+        """
+        path = StatCache.normalize(path)
+        with self.lock:
+            return path in self.memory or path in self.disk
+
+
+    def put(self, path, key, data):
+        if len(data) > self.maxFileSize:
+            return
+        with self.lock:
+            self._keep(StatCache.normalize(path), key, bytes(data))
+
+
+    def invalidate(self, path):
+        """
+        Forget path and, if it is a folder, everything below it (because it was written to,
+        renamed or deleted).
+        """
+        path    = StatCache.normalize(path)
+        prefix  = path.rstrip("/") + "/"
+        with self.lock:
+            for p in [p for p in list(self.memory) + list(self.disk) if p == path or p.startswith(prefix)]:
+                self._drop(p)
+
+
+    def metrics(self):
+        with self.lock:
+            return {"contentHits": self.hits, "contentMisses": self.misses,
+                    "contentBytes": self.used, "contentSpilled": self.spilled}
+
+
+    def _keep(self, path, key, data):
+        self._drop(path)
+        self.memory[path]   = (key, data)
+        self.used          += len(data)
+        while self.used > self.budget:
+            old, (oldKey, oldData) = self.memory.popitem(last = False)
+            self.used -= len(oldData)
+            self._spill(old, oldKey, oldData)
+
+
+    def _spill(self, path, key, data):
+        if self.spillFolder is None or len(data) > self.spillBudget:
+            return
+        if self.folder is None:
+            os.makedirs(self.spillFolder, exist_ok = True)
+            self.folder = tempfile.mkdtemp(prefix = "mpFPTel-", dir = self.spillFolder)
+            atexit.register(shutil.rmtree, self.folder, True)
+        fileName = os.path.join(self.folder, sha1(path.encode("utf-8")).hexdigest())
+        with open(fileName, "wb") as f:
+            f.write(data)
+        self.disk[path] = (key, fileName, len(data))
+        self.spilled   += len(data)
+        while self.spilled > self.spillBudget:
+            _, (_, oldFile, size) = self.disk.popitem(last = False)
+            self.spilled -= size
+            os.remove(oldFile)
+
+
+    def _drop(self, path):
+        entry = self.memory.pop(path, None)
+        if entry is not None:
+            self.used -= len(entry[1])
+        entry = self.disk.pop(path, None)
+        if entry is not None:
+            self.spilled -= entry[2]
+            os.remove(entry[1])
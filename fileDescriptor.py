@@ -1,50 +1,156 @@
-
 from collections import namedtuple
 import posixpath
 
 
-FileStat = namedtuple("FileStat", "mode ino dev nlink uid gid size atime mtime ctime")    
+FileStat = namedtuple("FileStat", "mode ino dev nlink uid gid size atime mtime ctime")
+
+FOLDER_STAT = FileStat(16384, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+FILE_TYPES  = {"py":"python source"}
+
 
 class FileDescriptor(object):
+    """
+    A file or folder on the board. The size of a folder is that of everything below it; it is
+    kept up to date as children are added, removed or resized, rather than counted on each call.
+    """
+    __slots__ = ("name", "path", "_size", "time", "isDir", "parent", "index")
+
     def __init__(self, fileName, stats, path, parent = None):
         self.name = fileName
         self.path = path
-        self._size= stats.size
+        self._size= 0 if (stats.mode & 16384) > 0 else stats.size
         self.time = stats.mtime
         self.isDir= (stats.mode & 16384) > 0
         self.parent     = parent
-        self.children   = [] if self.isDir else ()
+        self.index      = {} if self.isDir else None    # name: child, in the order they were added
+
+
+    @property
+    def children(self):
+        return list(self.index.values()) if self.isDir else []
+
+
+    @property
+    def type(self):
         if self.isDir:
-            self.type = "<folder>"
-        else:
-            reg = {"py":"python source"}
-            ext = posixpath.splitext(self.name)[1][1:]
-            self.type = reg.get(ext, "%s-file" % ext)
-                    
+            return "<folder>"
+        ext = posixpath.splitext(self.name)[1][1:]
+        return FILE_TYPES.get(ext, "%s-file" % ext)
+
 
     def __str__(self):
         return "%-20s:%6d bytes [%s]" % (("* " if self.isDir else "") + self.name, self.size(), self.path)
-    
+
+
+    def _grow(self, delta):
+        node = self
+        while node is not None:
+            node._size += delta
+            node = node.parent
+
 
     def addChildren(self, files):
         for f in files:
             f.parent = self
-            self.children.append(f)
+            self.index[f.name] = f
+            self._grow(f._size)
+
+    def removeChild(self, name):
+        f = self.index.pop(name)
+        self._grow(-f._size)
+        f.parent = None
+        return f
+
+    def child(self, name):
+        return self.index.get(name) if self.isDir else None
 
     def hasChildren(self):
-        return len(self.children) > 0
+        return bool(self.index)
 
     def isParent(self, path):
         if not path.endswith('/'):
             path += '/'
         return self.path == path
-    
+
     def size(self):
-        if self.isDir:
-            return sum([c.size() for c in self.children])
-        else:
-            return self._size
-    
+        return self._size
+
+    def resize(self, size):
+        """
+        Set the size of a file (e.g. after it was written to).
+        """
+        self._grow(size - self._size)
+
     def fullName(self):
         return posixpath.join(self.path, self.name)
-    
+
+
+
+class FileTree(object):
+    """
+    The files on the board as a tree of FileDescriptors, built in one pass from the
+    (name, folder, stats) tuples of PyBoardEx.ls, with an index by full path.
+    """
+
+    def __init__(self, entries = ()):
+        self.root   = FileDescriptor("", FOLDER_STAT, "/")
+        self.nodes  = {"/": self.root}
+        for name, path, stats in entries:
+            self.add(FileDescriptor(name, FileStat(*stats), path))
+
+
+    @classmethod
+    def key(cls, path):
+        return "/" + posixpath.normpath("/" + path).strip("/")
+
+
+    def add(self, node):
+        """
+        Add node below its folder; folders that are not known yet are created on the way.
+        """
+        parent = self.find(node.path)
+        if parent is None:
+            folder, name = posixpath.split(self.key(node.path))
+            parent = FileDescriptor(name, FOLDER_STAT, posixpath.join(folder, ""))
+            self.add(parent)
+        old = parent.child(node.name)
+        if old is not None:
+            if old.isDir and node.isDir:
+                old.time = node.time     # a folder that was created on the way
+                return
+            self.remove(old.fullName())
+        parent.addChildren([node])
+        self.nodes[self.key(node.fullName())] = node
+
+
+    def remove(self, path):
+        node = self.find(path)
+        if node is None or node.parent is None:
+            return None
+        del self.nodes[self.key(path)]
+        node.parent.removeChild(node.name)
+        if node.isDir:
+            prefix = self.key(path) + "/"
+            for key in [k for k in self.nodes if k.startswith(prefix)]:
+                del self.nodes[key]
+        return node
+
+
+    def find(self, path):
+        return self.nodes.get(self.key(path))
+
+
+    def __len__(self):
+        return len(self.nodes) - 1
+
+
+    def __iter__(self):
+        """
+        All files and folders, each folder before its content.
+        """
+        stack = list(reversed(self.root.children))
+        while stack:
+            node = stack.pop()
+            yield node
+            if node.isDir:
+                stack.extend(reversed(node.children))
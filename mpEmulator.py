@@ -0,0 +1,621 @@
+"""
+Software stand-in for a MicroPython board.
+
+The emulator speaks the raw-REPL protocol (including raw-paste mode) and the
+friendly REPL over a serial-like transport, and executes whatever the host
+sends against a sandboxed directory on the host computer. It allows the serial
+path of PyBoardEx to be exercised, measured and regression-tested without
+hardware:
+
+    board = Microterm(transport = EmulatedSerial("/tmp/board"))
+
+Link speed, latency and heap size are configurable so that the emulator gives
+an impression of the real thing; the heap only approximates what compiling the
+code that is sent takes (see EmulatedBoard.checkHeap). Run this module to serve
+an emulated board on a pseudo terminal (not on Windows), for programs that want
+a serial device:
+
+    python mpEmulator.py /tmp/board
+"""
+import builtins
+import sys
+import errno
+import os
+import posixpath
+import threading
+import time
+import types
+import zlib
+from collections import deque, namedtuple
+
+
+RAW_BANNER      = b'raw REPL; CTRL-B to exit\r\n>'
+FRIENDLY_BANNER = b'\r\nMicroPython v1.22.0 on 2024-01-01; emulator\r\nType "help()" for more information.\r\n>>> '
+PASTE_WINDOW    = 128
+
+UName = namedtuple("UName", "sysname nodename release version machine")
+
+
+
+class SandboxOS(types.ModuleType):
+    """
+    Subset of MicroPython's os module, confined to the root directory of the emulator.
+    """
+
+    def __init__(self, root):
+        super().__init__("os")
+        self.root   = os.path.abspath(root)
+        self.cwd    = "/"
+        os.makedirs(self.root, exist_ok = True)
+
+
+    def hostPath(self, path):
+        path = posixpath.normpath(posixpath.join(self.cwd, path))
+        return os.path.join(self.root, *[p for p in path.split('/') if p not in ("", ".", "..")])
+
+
+    def _call(self, fn, *args):
+        try:
+            return fn(*args)
+        except OSError as e:
+            raise OSError(e.errno, errno.errorcode.get(e.errno, "EIO")) from None
+
+
+    def listdir(self, path = "."):
+        return sorted(self._call(os.listdir, self.hostPath(path)))
+
+    def ilistdir(self, path = "."):
+        for name in self.listdir(path):
+            mode = self.stat(posixpath.join(path, name))[0]
+            yield (name, mode, 0, 0)
+
+    def stat(self, path):
+        s = self._call(os.stat, self.hostPath(path))
+        mode = 0x4000 if os.path.isdir(self.hostPath(path)) else 0x8000
+        size = 0 if mode == 0x4000 else s.st_size
+        return (mode, 0, 0, 0, 0, 0, size, int(s.st_mtime), int(s.st_mtime), int(s.st_mtime))
+
+    def mkdir(self, path):
+        self._call(os.mkdir, self.hostPath(path))
+
+    def rmdir(self, path):
+        self._call(os.rmdir, self.hostPath(path))
+
+    def remove(self, path):
+        if os.path.isdir(self.hostPath(path)):
+            raise OSError(errno.EISDIR, "EISDIR")
+        self._call(os.remove, self.hostPath(path))
+
+    def rename(self, oldName, newName):
+        self._call(os.rename, self.hostPath(oldName), self.hostPath(newName))
+
+    def chdir(self, path):
+        if not os.path.isdir(self.hostPath(path)):
+            raise OSError(errno.ENOENT, "ENOENT")
+        self.cwd = posixpath.normpath(posixpath.join(self.cwd, path))
+
+    def getcwd(self):
+        return self.cwd
+
+    def uname(self):
+        return types.SimpleNamespace(**UName("emulator", "emulator", "1.22.0",
+                                             "v1.22.0 on 2024-01-01", "software emulator")._asdict())
+
+    def statvfs(self, path):
+        return (4096, 4096, 1024, 512, 512, 0, 0, 0, 0, 255)
+
+
+
+class BoardStdout(object):
+    """
+    sys.stdout of the board; text output is 'cooked' (\n -> \r\n), the buffer is raw.
+    """
+
+    def __init__(self, board, cooked = True):
+        self.board  = board
+        self.cooked = cooked
+        self.buffer = self if not cooked else BoardStdout(board, False)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        data = bytes(data)
+        if self.cooked:
+            data = data.replace(b'\n', b'\r\n')
+        self.board.emit(data)
+        return len(data)
+
+
+
+class BoardStdin(object):
+
+    def __init__(self, board):
+        self.board  = board
+        self.buffer = self
+
+    def read(self, n = 1):
+        return bytes(self.board.take(n))
+
+    def readinto(self, buf, n = -1):
+        n = len(buf) if n < 0 else n
+        data = self.board.take(n)
+        buf[:len(data)] = data
+        return len(data)
+
+
+
+class EmulatedBoard(object):
+    """
+    The 'firmware': a thread that consumes the bytes the host writes and produces the
+    responses a MicroPython board would give.
+    """
+
+    def __init__(self, root, heapSize = 100000, hasDeflate = True, hasRawPaste = True, platform = "emulator"):
+        self.heapSize   = heapSize
+        self.platform   = platform
+        self.uartBaud   = None
+        self.hasDeflate = hasDeflate
+        self.hasRawPaste= hasRawPaste
+        self.os         = SandboxOS(root)
+        self.inbound    = deque()
+        self.inReady    = threading.Condition()
+        self.transport  = None
+        self.kbdIntr    = 3
+        self.mode       = "friendly"
+        self.line       = ""
+        self.commands   = 0     # executed, i.e. round trips
+        self.resets     = 0
+        self.softReset()
+        self.thread     = threading.Thread(target = self.run, daemon = True)
+        self.running    = True
+        self.thread.start()
+
+
+    def softReset(self):
+        self.resets    += 1 if hasattr(self, "globals") else 0
+        self.globals    = {"__name__": "__main__", "__builtins__": self.builtins()}
+        self.modules    = {}
+
+
+    def builtins(self):
+        names = dict(vars(builtins))
+        names["__import__"] = self.importModule
+        names["print"]      = self.printOut
+        names["open"]       = self.openFile
+        return names
+
+
+    def printOut(self, *args, sep = " ", end = "\n", file = None):
+        (file or self.sys.stdout).write(sep.join(str(a) for a in args) + end)
+
+
+    def openFile(self, name, mode = "r", *args, **kwargs):
+        return open(self.os.hostPath(name), mode, *args, **kwargs)
+
+
+    @property
+    def sys(self):
+        if "sys" not in self.modules:
+            mod = types.ModuleType("sys")
+            mod.stdout          = BoardStdout(self)
+            mod.stdin           = BoardStdin(self)
+            mod.platform        = self.platform
+            mod.implementation  = types.SimpleNamespace(name = "micropython", version = (1, 22, 0))
+            mod.modules         = self.modules
+            self.modules["sys"] = mod
+        return self.modules["sys"]
+
+
+    def importModule(self, name, globals = None, locals = None, fromlist = (), level = 0):
+        if name in self.modules:
+            return self.modules[name]
+        if name == "sys":
+            return self.sys
+        mod = types.ModuleType(name)
+        if name == "os":
+            mod = self.os
+        elif name == "micropython":
+            mod.kbd_intr        = self.setKbdIntr
+        elif name == "gc":
+            mod.collect         = lambda: None
+            mod.mem_free        = lambda: self.heapSize
+        elif name in ("hashlib", "binascii", "time", "struct", "io"):
+            mod = __import__(name)
+        elif name == "zlib":
+            mod.DecompIO        = lambda stream, wbits = 0: DecompressingReader(stream)
+        elif name == "deflate" and self.hasDeflate:
+            mod.ZLIB, mod.RAW, mod.GZIP, mod.AUTO = 1, 2, 3, 0
+            mod.DeflateIO       = DeflateIO
+        elif name == "machine":
+            mod.UART            = lambda *args, **kwargs: EmulatedUART(self)
+        elif name == "select":
+            mod.POLLIN          = 1
+            mod.poll            = lambda: EmulatedPoll(self)
+        else:
+            path = self.os.hostPath(name + ".py")
+            if not os.path.exists(path):
+                raise ImportError("no module named '%s'" % name)
+            with open(path) as f:
+                source = f.read()
+            self.checkHeap(source)
+            mod.__dict__["__builtins__"] = self.globals["__builtins__"]
+            exec(compile(source, name + ".py", "exec"), mod.__dict__)
+        self.modules[name] = mod
+        return mod
+
+
+    def setKbdIntr(self, char):
+        self.kbdIntr = char
+
+
+    def checkHeap(self, source):
+        """
+        A rough stand-in for the heap: compiling source is taken to need 4 bytes per byte of
+        it, which fails beyond heapSize. What the code allocates while it runs is not counted.
+        """
+        if len(source) * 4 > self.heapSize:
+            raise MemoryError("memory allocation failed, allocating %d bytes" % (len(source) * 4))
+
+    # ------------------------------------------------- transport side
+
+    def feed(self, data):
+        with self.inReady:
+            self.inbound.extend(data)
+            self.inReady.notify_all()
+
+
+    def take(self, n):
+        result = bytearray()
+        with self.inReady:
+            while len(result) < n:
+                while not self.inbound:
+                    self.inReady.wait()
+                result.append(self.inbound.popleft())
+        return result
+
+
+    def emit(self, data):
+        self.transport.deliver(data)
+
+    # ------------------------------------------------- firmware
+
+    def run(self):
+        while self.running:
+            c = self.take(1)[0]
+            if self.mode == "friendly":
+                self.friendly(c)
+            else:
+                self.raw(c)
+
+
+    def friendly(self, c):
+        if c == 1:
+            self.mode, self.code = "raw", bytearray()
+            self.emit(b'\r\n' + RAW_BANNER)
+        elif c == 3:
+            self.line = ""
+            self.emit(b'\r\nKeyboardInterrupt: \r\n>>> ')
+        elif c == 4:
+            self.softReset()
+            self.emit(b'MPY: soft reboot' + FRIENDLY_BANNER)
+        elif c == 13:
+            line, self.line = self.line, ""
+            self.emit(b'\r\n')
+            if line.strip():
+                self.commands += 1
+                self.execute(line, interactive = True)
+            self.emit(b'>>> ')
+        elif c == 10:
+            pass
+        else:
+            self.line += chr(c)
+            self.emit(bytes([c]))
+
+
+    def raw(self, c):
+        if c == 2:
+            self.mode = "friendly"
+            self.emit(FRIENDLY_BANNER)
+        elif c == 3:
+            self.code = bytearray()
+        elif c == 5 and self.code == b'':
+            self.rawPaste()
+        elif c == 4:
+            if len(self.code) == 0:
+                self.softReset()
+                self.emit(b'OK\r\nMPY: soft reboot\r\n' + RAW_BANNER)
+                return
+            code, self.code = bytes(self.code), bytearray()
+            self.emit(b'OK')
+            self.runRaw(code)
+        else:
+            self.code.append(c)
+
+
+    def rawPaste(self):
+        if self.take(2) != b'A\x01':
+            return
+        if not self.hasRawPaste:
+            self.emit(b'R\x00')
+            return
+        # the window size, and a first window granted up front (as mp_reader_new_stdin does)
+        self.emit(b'R\x01' + PASTE_WINDOW.to_bytes(2, "little") + b'\x01')
+        code        = bytearray()
+        remaining   = PASTE_WINDOW
+        while True:
+            c = self.take(1)[0]
+            if c == 4:
+                break
+            code.append(c)
+            remaining -= 1
+            if remaining == 0:
+                remaining = PASTE_WINDOW
+                self.emit(b'\x01')
+        self.emit(b'\x04')
+        self.runRaw(bytes(code))
+
+
+    def runRaw(self, code):
+        self.commands += 1
+        error = self.execute(code.decode("utf-8"))
+        self.emit(b'\x04' + error + b'\x04>')
+
+
+    def execute(self, code, interactive = False):
+        try:
+            self.checkHeap(code)
+            if interactive:
+                try:
+                    result = eval(compile(code, "<stdin>", "eval"), self.globals)
+                    if result is not None:
+                        self.sys.stdout.write(repr(result) + "\n")
+                    return b''
+                except SyntaxError:
+                    pass
+            exec(compile(code, "<stdin>", "exec"), self.globals)
+            return b''
+        except BaseException as e:
+            name = "OSError" if isinstance(e, OSError) else type(e).__name__
+            if isinstance(e, OSError) and e.errno is not None:
+                text = "[Errno %d] %s" % (e.errno, errno.errorcode.get(e.errno, "EIO"))
+            else:
+                text = str(e)
+            tb = 'Traceback (most recent call last):\r\n  File "<stdin>", line 1, in <module>\r\n%s: %s\r\n' % (name, text)
+            if interactive:
+                self.emit(tb.encode("utf-8"))
+                return b''
+            return tb.encode("utf-8")
+
+
+
+class EmulatedUART(object):
+    """
+    machine.UART, of which only the baud rate matters (see EmulatedSerial.garbled).
+    """
+
+    def __init__(self, board):
+        self.board = board
+
+    def init(self, baudrate = None, **kwargs):
+        self.board.uartBaud = baudrate
+
+
+
+class EmulatedPoll(object):
+    """
+    select.poll, for the board's stdin only.
+    """
+
+    def __init__(self, board):
+        self.board = board
+
+    def register(self, stream, mask = 1):
+        pass
+
+    def poll(self, timeout = -1):
+        deadline = time.time() + timeout / 1000.0
+        with self.board.inReady:
+            while not self.board.inbound:
+                if timeout >= 0 and time.time() >= deadline:
+                    return []
+                self.board.inReady.wait(None if timeout < 0 else max(0.0, deadline - time.time()))
+        return [(None, 1)]
+
+
+
+class DecompressingReader(object):
+    """
+    zlib.DecompIO: decompresses a stream while it is read.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.zobj   = zlib.decompressobj()
+        self.pending= b''
+
+    def read(self, n = -1):
+        while (n < 0 or len(self.pending) < n) and not self.zobj.eof:
+            data = self.stream.read(256)
+            if not data:
+                break
+            self.pending += self.zobj.decompress(data)
+        if n < 0:
+            n = len(self.pending)
+        result, self.pending = self.pending[:n], self.pending[n:]
+        return result
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.stream.close()
+
+
+
+class DeflateIO(DecompressingReader):
+    """
+    deflate.DeflateIO: decompresses when read, compresses when written to.
+    """
+
+    def __init__(self, stream, format = 0, wbits = 0, close = False):
+        super().__init__(stream)
+        self.cobj   = zlib.compressobj()
+
+    def write(self, data):
+        self.stream.write(self.cobj.compress(bytes(data)))
+        return len(data)
+
+    def close(self):
+        self.stream.write(self.cobj.flush())
+        self.stream.close()
+
+
+
+class EmulatedSerial(object):
+    """
+    Serial-port-like transport to an EmulatedBoard; a drop-in for serial.Serial.
+    The link is modelled by its baud rate (10 bits per byte) and a fixed latency
+    per transfer direction.
+    """
+
+    def __init__(self, root, baudrate = None, latency = 0.0, timeout = 10, maxBaud = None, **boardOptions):
+        self.baudrate   = baudrate
+        self.maxBaud    = maxBaud
+        self.latency    = latency
+        self.timeout    = timeout
+        self.port       = "emulator:" + root
+        self.outbound   = deque()
+        self.outReady   = threading.Condition()
+        self.busyUntil  = 0.0
+        self.board      = EmulatedBoard(root, **boardOptions)
+        self.board.transport = self
+        self.is_open    = True
+        self.bytesSent      = 0
+        self.bytesReceived  = 0
+
+
+    def transferTime(self, count):
+        return self.latency + (0.0 if not self.baudrate else count * 10.0 / self.baudrate)
+
+
+    def garbled(self, data):
+        # both ends must run at the same rate, which the board's UART can handle
+        uart = self.board.uartBaud
+        if uart is not None and (uart != self.baudrate or (self.maxBaud and uart > self.maxBaud)):
+            return b'\xff' * len(data)
+        return data
+
+
+    def deliver(self, data):
+        data = self.garbled(data)
+        with self.outReady:
+            self.bytesReceived += len(data)
+            at = max(time.time(), self.busyUntil) + self.transferTime(len(data))
+            self.busyUntil = at
+            self.outbound.append((at, bytes(data)))
+            self.outReady.notify_all()
+
+
+    def _available(self):
+        now = time.time()
+        return sum([len(d) for t, d in self.outbound if t <= now])
+
+
+    def write(self, data):
+        delay = self.transferTime(len(data))
+        if delay:
+            time.sleep(delay)
+        self.bytesSent += len(data)
+        self.board.feed(self.garbled(bytes(data)))
+        return len(data)
+
+
+    def read(self, size = 1):
+        result   = bytearray()
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self.outReady:
+            while len(result) < size:
+                if self.outbound and self.outbound[0][0] <= time.time():
+                    t, data = self.outbound.popleft()
+                    take = size - len(result)
+                    result += data[:take]
+                    if len(data) > take:
+                        self.outbound.appendleft((t, data[take:]))
+                    continue
+                wait = 0.05 if not self.outbound else max(0.0, self.outbound[0][0] - time.time())
+                if deadline is not None:
+                    if time.time() >= deadline:
+                        break
+                    wait = min(wait, deadline - time.time())
+                self.outReady.wait(wait)
+        return bytes(result)
+
+
+    def read_until(self, expected = b'\n', size = None):
+        result = bytearray()
+        while not result.endswith(expected) and (size is None or len(result) < size):
+            c = self.read(1)
+            if not c:
+                break
+            result += c
+        return bytes(result)
+
+
+    def inWaiting(self):
+        with self.outReady:
+            return self._available()
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+
+    def flushInput(self):
+        with self.outReady:
+            self.outbound.clear()
+
+    reset_input_buffer = flushInput
+
+
+    def close(self):
+        self.is_open = False
+
+
+
+class PtyTransport(object):
+    """
+    Serves an EmulatedBoard on a pseudo terminal; connect to it by the name in device.
+    """
+
+    def __init__(self, root, **boardOptions):
+        import pty
+        import tty
+        self.master, slave  = pty.openpty()
+        tty.setraw(slave)
+        self.device         = os.ttyname(slave)
+        self.board          = EmulatedBoard(root, **boardOptions)
+        self.board.transport = self
+        self.thread         = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+
+    def deliver(self, data):
+        os.write(self.master, data)
+
+
+    def run(self):
+        while True:
+            self.board.feed(os.read(self.master, 1024))
+
+
+
+if __name__ == '__main__':
+    transport = PtyTransport(sys.argv[1] if len(sys.argv) > 1 else "emulatedBoard")
+    print("emulated board on", transport.device, "(Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
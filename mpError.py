@@ -48,8 +48,17 @@ class PyboardOSError(PyboardErrorEx):
                                         "" if source is None else source)
     
 
+    @classmethod
+    def fromCall(cls, methodName, *args):
+        """
+        Create the error as if the board raised it when calling methodName(*args).
+        """
+        error = cls("Exception", b'', ("[Errno %d]" % cls.errNo).encode("utf-8"))
+        error.transmogrify(methodName, *args)
+        return error
+    
+
     def transmogrify(self, methodName, *args):
-        print("TRANS")
         params = ", ".join([str(a) if not isinstance(a, str) else "'%s'" % a for a in args])        
         self.message = "%s: %s(%s)" % (self.errorText, methodName, params)
         
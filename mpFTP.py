@@ -3,11 +3,18 @@ from pyftpdlib.handlers import FTPHandler
 from pyftpdlib.filesystems import AbstractedFS
 from pyftpdlib._compat import unicode
 from _io import BytesIO
-import inspect
-from functools import partial
 import posixpath
 from mpError import ResourceNotFound
-from pyftpdlib.servers import FTPServer
+from bundle import BUNDLE_NAME, TarStream, TarUnpacker
+from pyftpdlib.servers import FTPServer, ThreadedFTPServer
+import threading
+import errno
+import os
+import stat
+
+
+POOL_ROOT_STAT = os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 1, 0, 0, 0, 0, 0, 0))
+BUNDLE_STAT    = os.stat_result((stat.S_IFREG | 0o644, 0, 0, 1, 0, 0, 0, 0, 0, 0))
 
 
 class IndirectFile(BytesIO):
@@ -15,14 +22,17 @@ class IndirectFile(BytesIO):
     File-like with intermediate buffer, so the content may be read/writen from/to the board
     by separate phases.
     Do not instantiate DirectFile but use open() to create an instance of one of its descendants.
-    No provision for appending to files!
+    Downloads need no intermediate buffer: they are served while the board sends them,
+    and so are uploads if streaming is True, except those that are compiled first.
+    No provision for appending to files, unless streaming!
     """
     
     @classmethod
-    def open(cls, fileName, mode, board):
+    def open(cls, fileName, mode, board, streaming = False):
         
-        fcls = DownloadFile if mode.startswith("r") else UploadFile
-        return fcls(fileName, mode, board)
+        if mode.startswith("r") or (streaming and not board.compiles(fileName)):
+            return board.openOnBoard(fileName, mode)
+        return UploadFile(fileName, mode, board)
     
     
     def __init__(self, fileName, mode, board):
@@ -32,51 +42,31 @@ class IndirectFile(BytesIO):
         self.mode   = mode
     
     
-class DownloadFile(IndirectFile):
-    """
-    To download a file from the board, first copy the content in the in-memory buffer
-    and then return this file-like buffer.
-    """ 
-    
-    def __init__(self, fileName, mode, board):
-        super().__init__(fileName, mode, board)
-        content = board.copyFileFromBoard(fileName)
-        if isinstance(content, str):
-            content = content.encode("utf-8")
-        self.write(content)
-        self.seek(0)
-    
-
-                
 class UploadFile(IndirectFile):
     """
     To upload a file to the board, copy the incoming file to the file-like in-memory buffer
     and then upload the entire file at once to the board.
     """
     
-    def __init__(self, fileName, mode, board):
-        print("UPLOAD", fileName)
-        super().__init__(fileName, mode, board)
-#         with open("r:/" + fileName, "rb") as f:
-#             content = f.read()
-#             self.write(content)
-            
     def close(self):
-        print("size of %s: %s" % (self.name, self.tell()))
         self.seek(0)
         self.board.copyFileToBoard(self.name, self)    
         super().close()
-
-    def write(self, *args):
-        print(args)
-        return super().write(*args)
-        
-    def writelines(self, *args, **kwargs):
-        print(args)
-        return super().writelines(*args, **kwargs)
        
        
         
+class Listing(list):
+    """
+    The names in a folder, as returned by MPFS.listdir(), that also knows the stats that
+    came with them (by path), so the listing can be formatted without asking the board again.
+    """
+    
+    def __init__(self, folder, entries):
+        super().__init__([name for name, _ in entries])
+        self.stats = dict([(posixpath.join(folder, name), stats) for name, stats in entries])
+    
+    
+
 class AnonAuthorizer(DummyAuthorizer):
     """
     Authorizer that poses no limits to the anonymous user.
@@ -129,35 +119,35 @@ class MPFS(AbstractedFS):
     """
     
     board = None  # to be set before first object instantiation
-    debug = False # set to True to have all method calls printed to the console
+    pool  = None  # ... or a BoardPool, of which every board is a top-level folder
+    debug = False # set to True to have all method calls printed to the console (see tracing)
+    streamUploads = True  # False: upload to the board only after the entire file is received
+    deleteDelay   = 0     # seconds to collect deletions for a batch, e.g. 0.2; 0: delete immediately
+    _flushTimers  = {}    # board: the timer that runs its batch of deletions
+    _flushLock    = threading.Lock()
     
     def __init__(self, root, cmd_channel):
         super().__init__("/", cmd_channel)
-        if self.debug:
-            self.__prepare()
+        self.listed = {}    # path: stats, of the listing being formatted
     
-
-    def __methodCall(self, fn, *args, **kwargs):
+    
+    def locate(self, path, rootAllowed = False):
         """
-        print 'calling methodName(arg, ...)' and then execute the method call itself.
+        Return the board and the path on the board. With a pool of boards, the first folder
+        of the path names the board; for the root of the pool itself, the board is None.
         """
-        params = ", ".join([str(a) for a in args] + ["%s=%s" % a for a in kwargs.items()])        
-        print("calling %s(%s)" %(fn.__qualname__, params))
-        return fn(*args, **kwargs)
-    
-    
-    def __prepare(self):
-        """ 
-        Wrap all our public methods (inherited included) in __methodCall
-        so usage be logged to the console
-        """  
-        names = [ n for n in sorted(dir(self), key=str.lower) if not n.startswith('_')]
-        meths = [getattr(self, n) for n in names if inspect.ismethod(getattr(self, n))]
-        for method in meths:
-            fn = partial(self.__methodCall, method)
-            setattr(self, method.__name__, fn)
-
-    # ----------------------------------------------
+        if self.pool is None:
+            return self.board, path
+        name, _, rest = self.normpath("/" + path).lstrip("/").partition("/")
+        if not name:
+            if not rootAllowed:
+                raise PermissionError(errno.EACCES, "not on any board", path)
+            return None, "/"
+        board = self.pool.get(name)
+        if board is None:
+            raise FileNotFoundError(errno.ENOENT, "no board named %s" % name, path)
+        return board, "/" + rest
+    
                 
     def ftp2fs(self, ftppath):
         """Translate a "virtual" ftp pathname (typically the raw string
@@ -182,12 +172,19 @@ class MPFS(AbstractedFS):
     def open(self, fileName, mode):
         """
         Open a file returning its handler.
-        Since directly opening files on the board is not possible, an IndirectFile instance is returned
-        that buffers / prereads the file content to / from the board.
+        Since directly opening files on the board is not possible, a file-like is returned
+        that streams the file content from the board, or buffers it to be written to the board.
         Quite likely, mode = "a" will create issues here.
         """
         assert isinstance(fileName, unicode), fileName
-        return IndirectFile.open(fileName, mode, self.board)
+        board, fileName = self.locate(fileName)
+        if posixpath.basename(fileName) == BUNDLE_NAME:
+            # the tar of the folder: packed, or unpacked into it, by the board in one session
+            folder = posixpath.dirname(fileName)
+            if mode.startswith("r"):
+                return TarStream(board.openBundle(folder))
+            return TarUnpacker(board.openBundle(folder, "wb"))
+        return IndirectFile.open(fileName, mode, board, self.streamUploads)
     
 
     def chdir(self, path):
@@ -196,44 +193,75 @@ class MPFS(AbstractedFS):
         """
         # note: process cwd will be reset by the caller
         path = self.folderName(path)
-        self.board.chdir(path)
+        board, boardPath = self.locate(path, True)
+        if board is not None:
+            board.chdir(boardPath)
         self.cwd = self.fs2ftp(path)
         
         
     def mkdir(self, path):
         """Create the specified directory."""
         assert isinstance(path, unicode), path
-        self.board.mkdir(path)
+        board, path = self.locate(path)
+        board.mkdir(path)
 
 
     def listdir(self, path):
         """List the content of a directory."""
-        assert isinstance(path, unicode), path
-        print("listdir", path)
-        return self.board.ls(path, long_format=False)
+        return self.listdirinfo(path)
 
 
     def rmdir(self, path):
         """Remove the specified directory."""
         assert isinstance(path, unicode), path
-        self.board.rmdir(self.folderName(path))
+        board, path = self.locate(self.folderName(path))
+        board.rmdir(path)
 
 
     def remove(self, path):
-        """Remove the specified file."""
+        """Remove the specified file. Clients often delete many files in a row, so
+        with a deleteDelay the deletions are collected and sent to the board in one batch.
+        The client is then told a file is deleted before it is; should that fail, it is
+        reported on the console only (see PyBoardEx.flush()).
+        """
         assert isinstance(path, unicode), path
-        self.board.rm(path)
+        board, path = self.locate(path)
+        if self.deleteDelay <= 0:
+            board.rm(path)
+            return
+        board.rm(path, defer = True)
+        # connections have threads of their own, so the timer is not of any one's ioloop
+        with MPFS._flushLock:
+            timer = MPFS._flushTimers.get(board)
+            if timer is not None:
+                timer.cancel()
+            timer = MPFS._flushTimers[board] = threading.Timer(self.deleteDelay, board.settle)
+            timer.daemon = True
+            timer.start()
 
 
     def rename(self, src, dst):
         """Rename the specified src file to the dst filename."""
         assert isinstance(src, unicode), src
         assert isinstance(dst, unicode), dst
-        self.board.rename(src, dst)
+        board, src = self.locate(src)
+        other, dst = self.locate(dst)
+        if board is not other:
+            raise OSError(errno.EXDEV, "cannot rename from one board to another", dst)
+        board.rename(src, dst)
 
     def stat(self, path):
         """Perform a stat() system call on the given path."""
-        return self.board.fileInfo(self.realpath(path))
+        path    = self.realpath(path)
+        stats   = self.listed.pop(path, None)
+        if stats is not None:
+            return stats
+        board, path = self.locate(path, True)
+        if board is None:
+            return POOL_ROOT_STAT
+        if posixpath.basename(path) == BUNDLE_NAME:
+            return BUNDLE_STAT
+        return board.fileInfo(path)
 
     # --- Wrapper methods around os.path.* calls
     def islink(self, path):
@@ -243,8 +271,10 @@ class MPFS(AbstractedFS):
     def isdir(self, path):
         """Return True if path is a directory."""
         assert isinstance(path, unicode), path
-        print("isdir", path)
-        return self.board.isDir(path)
+        board, path = self.locate(path, True)
+        if posixpath.basename(path) == BUNDLE_NAME:
+            return False
+        return board is None or board.isDir(path)
 
 
     def folderName(self, path):
@@ -274,36 +304,57 @@ class MPFS(AbstractedFS):
 
 
     def chmod(self, path, mode):
-        print("calling chmod(%s)"  % (", ".join([str(a) for a in [path, mode]])))
         return # super().chmod(path, mode)
     
     
     def getmtime(self, path):
-        print("calling getmtime(%s)"  % (", ".join([str(a) for a in [path]])))
-        return self.board.fileInfo(path).st_mtime
+        return self.stat(path).st_mtime
     
     
     def getsize(self, path):
-        print("calling getsize(%s)"  % (", ".join([str(a) for a in [path]])))
-        return self.board.fileInfo(path).st_size
+        return self.stat(path).st_size
     
     
     def isfile(self, path):
-        print("calling isfile(%s)"  % (", ".join([str(a) for a in [path]])))
         return not self.isdir(path)
     
     
     def lexists(self, path):
-        print("calling lexists(%s)"  % (", ".join([str(a) for a in [path]])))
         try:
-            self.board.fileInfo(path, getFresh = True)
+            self.stat(path)
             return True
-        except ResourceNotFound:
+        except (ResourceNotFound, FileNotFoundError):
             return False
     
     
     def listdirinfo(self, path):
-        return self.listdir(path)
+        """
+        List the content of a directory, together with the stats of its entries, in a single
+        call to the board (see Listing).
+        """
+        assert isinstance(path, unicode), path
+        folder      = self.realpath(path)
+        board, path = self.locate(folder, True)
+        if board is None:
+            return Listing(folder, [(name, POOL_ROOT_STAT) for name in self.pool.names()])
+        return Listing(folder, [(name, os.stat_result(stats)) for name, _, stats in board.ls(path)])
+    
+    
+    def format_list(self, basedir, listing, ignore_err = True):
+        # the stats of the listing are for its formatting only, also if that is aborted
+        self.listed = getattr(listing, "stats", {})
+        try:
+            yield from super().format_list(basedir, listing, ignore_err)
+        finally:
+            self.listed = {}
+    
+    
+    def format_mlsx(self, basedir, listing, perms, facts, ignore_err = True):
+        self.listed = getattr(listing, "stats", {})
+        try:
+            yield from super().format_mlsx(basedir, listing, perms, facts, ignore_err)
+        finally:
+            self.listed = {}
     
     
     def lstat(self, path):
@@ -311,7 +362,6 @@ class MPFS(AbstractedFS):
     
     
     def readlink(self, path):
-        print("calling readlink(%s)"  % (", ".join([str(a) for a in [path]])))
         raise NotImplementedError("readlink")
     
     
@@ -323,6 +373,18 @@ class MPFS(AbstractedFS):
 class MPFTPHandler(FTPHandler):
     
     abstracted_fs   = MPFS
+    proto_cmds      = dict(FTPHandler.proto_cmds)
+    proto_cmds["SITE STATS"] = dict(perm = None, auth = True, arg = None,
+                                    help = "Syntax: SITE <SP> STATS (show the metrics of the board(s)).")
+    
+
+    def ftp_SITE_STATS(self, line):
+        """Report round trips, serial traffic and operation latencies, see boardMetrics."""
+        boards = list(MPFS.pool) if MPFS.pool is not None else [MPFS.board]
+        lines  = sum([board.metrics.report(board) for board in boards], [])
+        self.push("211-Board statistics:\r\n")
+        self.push("".join([" %s\r\n" % l for l in lines]))
+        self.respond("211 End of statistics.")
         
 
 class MPFTPServer(FTPServer):
@@ -345,7 +407,18 @@ class MPFTPServer(FTPServer):
         else:
             handler = self.handler(sock, self, ioloop=self.ioloop)
             handler.respond("refused")
-            handler.close()
+            handler.close_when_done()   # after the reply is sent, by the server's ioloop
+
+
+
+class MPThreadedFTPServer(MPFTPServer, ThreadedFTPServer):
+    """
+    Serves every connection in a thread of its own, so that transfers to different
+    boards of a pool run in parallel, and a long transfer does not hold up the control
+    connection of another client (a board gives way to short calls between chunks).
+    Connections are accepted by pyftpdlib's own ioloop (serve_forever()): pyftpdlib has
+    no asyncio backend, so FTP does not share the event loop of the Telnet server.
+    """
 
 
 
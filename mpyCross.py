@@ -0,0 +1,116 @@
+from hashlib import sha256
+from fnmatch import fnmatch
+import subprocess
+import posixpath
+import tempfile
+import shutil
+import os
+import re
+
+
+MPY_CACHE = os.path.join(os.path.expanduser("~"), ".mpFPTel-mpy")     # compiled files, by hash
+
+# the major version of the .mpy format, per the MicroPython release it came with
+MPY_VERSIONS = (((1, 19), 6), ((1, 12), 5), ((1, 11), 4), ((1, 9), 3))
+
+
+
+def mpyVersion(release):
+    """
+    The .mpy version that MicroPython release (e.g. "1.22.0" or "v1.22.0") loads; None if unknown.
+    """
+    m = re.match(r"v?(\d+)\.(\d+)", release or "")
+    if m is None:
+        return None
+    release = (int(m.group(1)), int(m.group(2)))
+    for since, version in MPY_VERSIONS:
+        if release >= since:
+            return version
+    return None
+
+
+
+class MpyCompiler(object):
+    """
+    Compiles .py files to .mpy with a local mpy-cross before they are uploaded, so the board
+    does not have to compile them on every import, and there is less to transfer. Only if
+    the bytecode of mpy-cross is that of the board's firmware (see PyBoardEx.getID()); if
+    not, or if mpy-cross is not found, files are uploaded as they are. The output is kept
+    by hash of the source, so unchanged files are not compiled again.
+    """
+
+    command     = "mpy-cross"
+    options     = ()                        # e.g. ("-O2",)
+    include     = ("*.py",)                 # patterns without a '/' are matched with the name
+    exclude     = ("boot.py", "main.py")    # run by name by the firmware, so kept as source
+    cacheFolder = MPY_CACHE
+
+    def __init__(self, board):
+        self.board      = board
+        self.path       = None
+        self.version    = None          # that of mpy-cross, as it tells
+        self.checked    = False
+
+
+    @classmethod
+    def matches(cls, fileName, patterns):
+        name = posixpath.basename(fileName)
+        return any([fnmatch(fileName if "/" in p else name, p) for p in patterns])
+
+
+    def wants(self, fileName):
+        return self.matches(fileName, self.include) and not self.matches(fileName, self.exclude)
+
+
+    def usable(self):
+        """
+        Whether mpy-cross is there and emits bytecode that the board loads; found out once.
+        """
+        if self.checked:
+            return self.path is not None
+        self.checked = True
+        path = shutil.which(self.command)
+        if path is None:
+            print("%s not found: .py files are uploaded as source" % self.command)
+            return False
+        self.version = subprocess.run([path, "--version"], capture_output = True, text = True).stdout.strip()
+        emits   = re.search(r"mpy v(\d+)", self.version)
+        emits   = int(emits.group(1)) if emits else mpyVersion(self.version.replace("MicroPython ", ""))
+        release = self.board.getID().get("release")
+        if emits is None or emits != mpyVersion(release):
+            print("%s (%s) does not match the board (MicroPython %s): .py files are uploaded as source" %
+                  (self.command, self.version, release))
+            return False
+        self.path = path
+        return True
+
+
+    def compile(self, fileName, data):
+        """
+        Return (name, content) of the .mpy file for source data of fileName (on the board),
+        None if the file is to be uploaded as it is.
+        """
+        if not self.wants(fileName) or not self.usable():
+            return None
+        key         = sha256("\0".join((self.version, " ".join(self.options), fileName)).encode("utf-8") +
+                             b"\0" + data).hexdigest()
+        cacheFile   = os.path.join(self.cacheFolder, key + ".mpy")
+        if not os.path.isfile(cacheFile):
+            os.makedirs(self.cacheFolder, exist_ok = True)
+            with tempfile.TemporaryDirectory() as folder:
+                source  = os.path.join(folder, posixpath.basename(fileName))
+                output  = os.path.join(folder, "output.mpy")
+                with open(source, "wb") as f:
+                    f.write(data)
+                result  = subprocess.run([self.path] + list(self.options) + ["-s", fileName, "-o", output, source],
+                                         capture_output = True, text = True)
+                if result.returncode != 0:
+                    print("%s: not compiled, uploaded as source\n%s" % (fileName, result.stderr.strip()))
+                    return None
+                os.replace(output, cacheFile)
+        with open(cacheFile, "rb") as f:
+            compiled = f.read()
+        self.board.metrics.compiled(len(data) - len(compiled))
+        if self.board.reportTransfers:
+            print("compiled %s: %d bytes instead of %d" % (fileName, len(compiled), len(data)))
+        return posixpath.splitext(fileName)[0] + ".mpy", compiled
@@ -1,17 +1,345 @@
 from inspect import getsource, signature, isfunction
+from hashlib import sha1
 
-def getFile(fileName, terminator, chunkSize):
+def getFile(fileName, terminator, chunkSize, offset, length, compressed):
+    # Sends 'R' (raw), 'C' (cooked: \n may become \r\n) or 'Z' (compressed: a zlib stream 
+    # in frames of 4 byte length + data, ending with an empty frame), the file size and the
+    # content from offset onwards, in segments of length bytes (all at once if length < 0,
+    # and if cooked). After a segment, if more is left, the host sends 'R' or 'Z' for the
+    # next one (raw or compressed), or 'S' to stop there.
     import sys
+    stdout  = getattr(sys.stdout, "buffer", None)
+    stdin   = getattr(sys.stdin, "buffer", sys.stdin)
+    deflate = None
+    if compressed and stdout:
+        try:
+            import deflate
+            import io
+            deflate.DeflateIO(io.BytesIO(), deflate.ZLIB, 10).write(b'?')
+        except Exception:
+            deflate = None     # no (compressing) deflate module in this firmware
+    buf     = bytearray(chunkSize)
+    mv      = memoryview(buf)
+    
+    class Frames(io.IOBase if deflate else object):
+        def write(self, data):
+            if len(data):
+                stdout.write(len(data).to_bytes(4, "big"))
+                stdout.write(data)
+            return len(data)
+    
     with open(fileName, 'rb') as f:
         size = f.seek(0, 2)
-        sys.stdout.write(size.to_bytes(4, "big"))
-        f.seek(0, 0)
-        while True:
-            result = f.read(chunkSize)
-            if result == b'':
+        f.seek(offset, 0)
+        cooked = not stdout
+        stdout = stdout or sys.stdout
+        zipped = deflate is not None
+        stdout.write(b'Z' if zipped else (b'C' if cooked else b'R'))
+        stdout.write(size.to_bytes(4, "big"))
+        remaining = size - offset
+        while remaining > 0:
+            segment = remaining if length < 0 or cooked else min(length, remaining)
+            out = deflate.DeflateIO(Frames(), deflate.ZLIB, 10) if zipped else stdout
+            while segment > 0:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                n = min(n, segment)
+                out.write(mv[:n])
+                segment     -= n
+                remaining   -= n
+            if zipped:
+                out.close()
+                stdout.write(bytes(4))
+            if segment > 0 or remaining <= 0:
+                break
+            go = stdin.read(1)
+            if go not in (b'R', b'Z'):
                 break
-            sys.stdout.write(result)
-    sys.stdout.write(terminator)
+            zipped = go == b'Z' and deflate is not None
+    stdout.write(terminator)
+
+
+def putFile(fileName, chunkSize, append, compressed):
+    # Receives frames (4 byte length + data) from stdin until an empty frame. Every frame
+    # is requested with ACK (0x06); the first byte sent tells whether frames hold raw 
+    # bytes ('R'), a zlib stream to be inflated ('Z', only if asked for) or must be base64
+    # encoded ('B') because Ctrl-C can not be disabled.
+    import sys
+    import os
+    import io
+    import micropython
+    import binascii
+    kbdIntr = getattr(micropython, "kbd_intr", None)
+    crc32   = getattr(binascii, "crc32", None)
+    stdin   = sys.stdin.buffer
+    stdout  = getattr(sys.stdout, "buffer", sys.stdout)
+    encoded = kbdIntr is None
+    inflate = None
+    if compressed and not encoded:
+        try:
+            import deflate
+            inflate = lambda stream: deflate.DeflateIO(stream, deflate.ZLIB)
+        except ImportError:
+            try:
+                import zlib
+                inflate = lambda stream: zlib.DecompIO(stream, 10)
+            except (ImportError, AttributeError):
+                pass
+    buf     = memoryview(bytearray(chunkSize * 4 // 3 + 4 if encoded else chunkSize))
+    header  = bytearray(4)
+    size    = 0
+    check   = 0
+    
+    def receive(mv):
+        n = 0
+        while n < len(mv):
+            n += stdin.readinto(mv[n:])
+            
+    class Frames(io.IOBase):
+        start   = 0
+        end     = 0
+        
+        def next(self):
+            stdout.write(b'\x06')
+            receive(memoryview(header))
+            self.start  = 0
+            self.end    = int.from_bytes(header, "big")
+            receive(buf[:self.end])
+            return self.end
+        
+        def readinto(self, out):
+            if self.start == self.end and not self.next():
+                return 0
+            n = min(len(out), self.end - self.start)
+            out[:n] = buf[self.start:self.start + n]
+            self.start += n
+            return n
+        
+        def read(self, n):
+            out = bytearray(n)
+            return out[:self.readinto(out)]
+            
+    with open(fileName, 'ab' if append else 'wb') as f:
+        if not encoded:
+            kbdIntr(-1)
+        try:
+            stdout.write(b'Z' if inflate else (b'B' if encoded else b'R'))
+            frames  = Frames()
+            stream  = inflate(frames) if inflate else None
+            out     = memoryview(bytearray(chunkSize)) if inflate else None
+            while True:
+                if stream:
+                    n = stream.readinto(out)
+                    data = out[:n]
+                else:
+                    n = frames.next()
+                    data = binascii.a2b_base64(buf[:n]) if encoded else buf[:n]
+                if not n:
+                    break
+                f.write(data)
+                size += len(data)
+                check = crc32(data, check) if crc32 else (check + sum(data)) & 0xffffffff
+            while stream and frames.readinto(header):
+                pass
+        finally:
+            if not encoded:
+                kbdIntr(3)
+    print((size, check, crc32 is not None, os.stat(fileName)))
+
+
+def getBundle(folder, chunkSize, compressed, skip):
+    # Sends 'R' or 'Z' (frames of 4 byte length + data, holding a zlib stream if 'Z', until an
+    # empty frame) or 'B' (the frames base64 encoded, a line each, until an empty line) with a
+    # record per folder and file below folder: type ('D' or 'F'), length of the path (2 bytes)
+    # and of the content (4 bytes), path (relative to folder) and content; 'E' ends the bundle.
+    # The paths in skip are left out.
+    import sys
+    import os
+    import io
+    import binascii
+    stdout  = getattr(sys.stdout, "buffer", None)
+    deflate = None
+    if compressed and stdout:
+        try:
+            import deflate
+            deflate.DeflateIO(io.BytesIO(), deflate.ZLIB, 10).write(b'?')
+        except Exception:
+            deflate = None     # no (compressing) deflate module in this firmware
+    buf     = bytearray(chunkSize)
+    mv      = memoryview(buf)
+
+    class Frames(io.IOBase):
+        pending = b''
+
+        def write(self, data):
+            self.pending += data
+            if len(self.pending) >= chunkSize:
+                self.flush()
+            return len(data)
+
+        def flush(self):
+            if not self.pending:
+                return
+            if stdout:
+                stdout.write(len(self.pending).to_bytes(4, "big"))
+                stdout.write(self.pending)
+            else:
+                sys.stdout.write(binascii.b2a_base64(self.pending).decode())
+            self.pending = b''
+
+    root    = folder.rstrip('/') + '/'
+    frames  = Frames()
+    out     = deflate.DeflateIO(frames, deflate.ZLIB, 10) if deflate else frames
+    stack   = [root]
+    os.stat(root)
+    (stdout or sys.stdout).write(b'Z' if deflate else b'R' if stdout else 'B')
+    while stack:
+        path = stack.pop()
+        for entry in os.ilistdir(path):
+            name    = path + entry[0]
+            if name in skip:
+                continue
+            stats   = os.stat(name)
+            isDir   = stats[0] & 16384
+            size    = 0 if isDir else stats[6]
+            relative= name[len(root):].encode()
+            out.write((b'D' if isDir else b'F') + len(relative).to_bytes(2, "big") +
+                      size.to_bytes(4, "big") + relative)
+            if isDir:
+                stack.append(name + '/')
+                continue
+            with open(name, 'rb') as f:
+                while size > 0:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    n = min(n, size)
+                    out.write(mv[:n])
+                    size -= n
+    out.write(b'E' + bytes(6))
+    if deflate:
+        out.close()
+    frames.flush()
+    (stdout or sys.stdout).write(bytes(4) if stdout else '\n')
+
+
+def putBundle(folder, chunkSize, compressed):
+    # Receives a bundle (see getBundle) in frames, as putFile does, and unpacks it into folder:
+    # 'D' creates a folder, 'F' (re)writes a file and 'A' appends to one (to the previous one if
+    # the path is empty). Prints the size and checksum of the bundle and the number of files.
+    import sys
+    import os
+    import io
+    import micropython
+    import binascii
+    kbdIntr = getattr(micropython, "kbd_intr", None)
+    crc32   = getattr(binascii, "crc32", None)
+    stdin   = sys.stdin.buffer
+    stdout  = getattr(sys.stdout, "buffer", sys.stdout)
+    encoded = kbdIntr is None
+    inflate = None
+    if compressed and not encoded:
+        try:
+            import deflate
+            inflate = lambda stream: deflate.DeflateIO(stream, deflate.ZLIB)
+        except ImportError:
+            try:
+                import zlib
+                inflate = lambda stream: zlib.DecompIO(stream, 10)
+            except (ImportError, AttributeError):
+                pass
+    buf     = memoryview(bytearray(chunkSize * 4 // 3 + 4 if encoded else chunkSize))
+    out     = memoryview(bytearray(chunkSize))
+    header  = bytearray(4)
+    record  = bytearray(7)
+    state   = [0, 0, 0]     # size, checksum, files
+
+    def receive(mv):
+        n = 0
+        while n < len(mv):
+            n += stdin.readinto(mv[n:])
+
+    class Frames(io.IOBase):
+        start   = 0
+        end     = 0
+        data    = buf
+
+        def next(self):
+            stdout.write(b'\x06')
+            receive(memoryview(header))
+            self.end    = int.from_bytes(header, "big")
+            receive(buf[:self.end])
+            self.data   = memoryview(binascii.a2b_base64(buf[:self.end])) if encoded else buf
+            self.start  = 0
+            self.end    = len(self.data) if encoded else self.end
+            return self.end
+
+        def readinto(self, out):
+            if self.start == self.end and not self.next():
+                return 0
+            n = min(len(out), self.end - self.start)
+            out[:n] = self.data[self.start:self.start + n]
+            self.start += n
+            return n
+
+        def read(self, n):
+            out = bytearray(n)
+            return out[:self.readinto(out)]
+
+    def take(mv):
+        n = 0
+        while n < len(mv):
+            k = stream.readinto(mv[n:])
+            if not k:
+                raise EOFError("bundle incomplete")
+            data = mv[n:n + k]
+            state[0] += k
+            state[1] = crc32(data, state[1]) if crc32 else (state[1] + sum(data)) & 0xffffffff
+            n += k
+        return mv
+
+    f = None
+    try:
+        os.mkdir(folder.rstrip('/'))
+    except OSError:
+        pass
+    if not encoded:
+        kbdIntr(-1)
+    try:
+        stdout.write(b'Z' if inflate else (b'B' if encoded else b'R'))
+        frames  = Frames()
+        stream  = inflate(frames) if inflate else frames
+        while take(memoryview(record))[0] != 69:    # 'E'
+            kind    = record[0]
+            path    = bytes(take(memoryview(bytearray(int.from_bytes(record[1:3], "big")))))
+            length  = int.from_bytes(record[3:7], "big")
+            if path or kind != 65:                  # not 'A' to the previous file
+                if f:
+                    f.close()
+                    f = None
+                path = folder + path.decode()
+            if kind == 68:                          # 'D'
+                try:
+                    os.mkdir(path)
+                except OSError:
+                    pass
+                continue
+            if f is None:
+                f = open(path, 'ab' if kind == 65 else 'wb')
+                state[2] += kind == 70              # 'F'
+            while length > 0:
+                n = min(length, chunkSize)
+                f.write(take(out[:n]))
+                length -= n
+        while frames.readinto(header):
+            pass
+    finally:
+        if f:
+            f.close()
+        if not encoded:
+            kbdIntr(3)
+    print((state[0], state[1], crc32 is not None, state[2]))
 
 
 def getFileInfo(fileName):
@@ -19,18 +347,51 @@ def getFileInfo(fileName):
     return os.stat(fileName)
 
     
-def scanDir(path, recurse):
-    import os
-    if not path.endswith('/'):
-        path += '/'
+def hashFiles(fileNames, chunkSize):
+    import binascii
+    try:
+        from hashlib import sha256
+    except ImportError:
+        sha256 = None
+    buffer  = bytearray(chunkSize)
+    mv      = memoryview(buffer)
     result  = []
-    for file in sorted(os.listdir(path + '.')):
-        stats = os.stat(path + file)
-        result.append((file, path, stats))
-        if recurse and ((stats[0] & 16384) > 0):
-            result.extend(scanDir(path + file, recurse))
+    for fileName in fileNames:
+        check = sha256() if sha256 else 0
+        try:
+            with open(fileName, 'rb') as f:
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    if sha256:
+                        check.update(mv[:n])
+                    else:
+                        check = binascii.crc32(mv[:n], check)
+        except OSError:
+            result.append(None)
+            continue
+        if sha256:
+            result.append("sha256:" + binascii.hexlify(check.digest()).decode())
+        else:
+            result.append("crc32:%08x" % (check & 0xffffffff))
     return result
 
+    
+# Prints per folder a line with its path, followed by a line "mode size mtime name" per entry,
+# as it goes: nothing is collected, so the heap does not limit the number of files.
+def walkDir(path, recurse):
+    import os
+    stack = [path]
+    while stack:
+        path = stack.pop().rstrip('/') + '/'
+        print(path)
+        for entry in os.ilistdir(path):
+            stats = os.stat(path + entry[0])
+            print(stats[0], stats[6], stats[8], entry[0])
+            if recurse and stats[0] & 16384:
+                stack.append(path + entry[0])
+
 
 def chDir(name):
     import os
@@ -40,6 +401,7 @@ def chDir(name):
 def mkDir(name):
     import os
     os.mkdir(name)
+    return os.stat(name)
 
 
 def rename(oldName, newName):
@@ -73,6 +435,38 @@ def deleteFolder(directory, deleteEvenIfNotEmpty):
     rmdir(directory)
 
 
+def linkInfo():
+    import gc
+    import sys
+    gc.collect()
+    return (gc.mem_free(), sys.platform)
+
+
+def setBaudRate(uart, baudrate, oldBaudrate, timeout):
+    # Sends 'S' and switches the REPL's UART to baudrate. There, the host is to send 'K', 
+    # which is answered with 'K', and then 'O'; otherwise (after timeout ms) the old rate
+    # is restored.
+    import sys
+    import time
+    import machine
+    import select
+    port    = machine.UART(uart)
+    poll    = select.poll()
+    poll.register(sys.stdin, select.POLLIN)
+    
+    def expect(c):
+        return poll.poll(timeout) and sys.stdin.buffer.read(1) == c
+    
+    sys.stdout.write('S')
+    time.sleep(0.02)
+    port.init(baudrate = baudrate)
+    if expect(b'K'):
+        sys.stdout.write('K')
+        if expect(b'O'):
+            return
+    port.init(baudrate = oldBaudrate)
+
+
 def getID():
     import os
     n = os.uname()  # @UndefinedVariable
@@ -83,20 +477,82 @@ snapshot = globals().copy()
 code    = {}
 params  = {}    
 for nm, fn in snapshot.items():
-    if isfunction(fn):
+    if isfunction(fn) and fn.__module__ == __name__:
         code[nm]    = getsource(fn)
         params[nm]  = signature(fn)
-        
-        
-def remoteCall(function, *args, returnResult = False):
-    source      = code[function]
+
+
+# The agent: all of the above as a module that is stored on the board's flash once,
+# after which a call only costs an opcode and its arguments.
+AGENT_MODULE    = "_mpagent"
+AGENT_FILE      = "/%s.py" % AGENT_MODULE
+opcodes         = dict([(nm, i) for i, nm in enumerate(sorted(code))])
+agentBody       = "\n".join([code[nm] for nm in sorted(code)]) + \
+                  "\n_OPS = (%s,)\n\ndef c(op, *args):\n    return _OPS[op](*args)\n" % ", ".join(sorted(code))
+AGENT_VERSION   = sha1(agentBody.encode("utf-8")).hexdigest()[:8]
+
+
+def agentSource():
+    return "VERSION = '%s'\n\n%s" % (AGENT_VERSION, agentBody)
+
+
+def agentProbe():
+    """
+    Code that prints the version of the agent installed on the board (None if absent).
+    """
+    return "import sys\nsys.modules.pop('%s', None)\ntry:\n    import %s\n    print(repr(%s.VERSION))\n" \
+           "except ImportError:\n    print(None)" % (AGENT_MODULE, AGENT_MODULE, AGENT_MODULE)
+
+
+def checkArgs(function, args):
     expectedArgCount = len(params[function].parameters)
     if (len(args) != expectedArgCount):
         raise TypeError("function operations.%s%s takes %d parameters" % (function, params[function], expectedArgCount)) 
-    args        = ", ".join([('"%s"' % arg) if isinstance(arg, str) else str(arg) for arg in args])
+    return ", ".join([('"%s"' % arg) if isinstance(arg, str) else str(arg) for arg in args])
+
+        
+def remoteCall(function, *args, returnResult = False):
+    source      = code[function]
+    args        = checkArgs(function, args)
     if returnResult:
         return  "%s\n\nprint(%s(%s))" % (source, function, args)
     else:
         return  "%s\n\n%s(%s)" % (source, function, args)
 
-    
\ No newline at end of file
+
+def agentCall(function, *args, returnResult = False):
+    args        = checkArgs(function, args)
+    args        = "%d, %s" % (opcodes[function], args) if args else str(opcodes[function])
+    if returnResult:
+        return  "from %s import c\nprint(c(%s))" % (AGENT_MODULE, args)
+    else:
+        return  "from %s import c\nc(%s)" % (AGENT_MODULE, args)
+
+
+def batchCall(calls, useAgent = False):
+    """
+    Code that runs a list of (function, arg, ...) calls and prints per call one line:
+    repr((0, result)) or, if it failed, repr((1, "ExceptionName: message")).
+    """
+    functions   = sorted(set([call[0] for call in calls]))
+    streaming   = [f for f in functions if f in ("getFile", "putFile", "getBundle", "putBundle", "walkDir")]
+    if streaming:
+        raise ValueError("operations.%s cannot be part of a batch" % streaming[0])
+    lines = ["def _b(f, *a):",
+             "    try:",
+             "        print(repr((0, f(*a))))",
+             "    except Exception as e:",
+             "        print(repr((1, '%s: %s' % (type(e).__name__, e))))"]
+    if useAgent:
+        lines.insert(0, "from %s import c" % AGENT_MODULE)
+    else:
+        lines[:0] = [code[f] for f in functions]
+    for call in calls:
+        args = checkArgs(call[0], call[1:])
+        if useAgent:
+            args = ", ".join(["c", str(opcodes[call[0]])] + ([args] if args else []))
+        else:
+            args = ", ".join([call[0]] + ([args] if args else []))
+        lines.append("_b(%s)" % args)
+    return "\n".join(lines)
+
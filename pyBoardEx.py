@@ -1,14 +1,29 @@
 import serial
 import stat
 import os
+import posixpath
+import errno
+import json
+from glob import glob
+import binascii
 from io import IOBase
-from time import sleep
+from collections import deque
+from time import sleep, time
+import zlib
+import threading
 from ampy import pyboard
 from ampy.pyboard import Pyboard, PyboardError
 
 import operations
-from fileDescriptor import FileDescriptor, FileStat
-from mpError import PyboardErrorFactory, PyboardOSError
+import bundle
+from fileDescriptor import FileStat, FileTree
+from mpError import PyboardErrorEx, PyboardErrorFactory, PyboardOSError, ResourceNotFound, FileExpected
+from statCache import StatCache
+from arbiter import BoardArbiter, INTERACTIVE, COMMAND, BULK, IDLE
+from boardSync import Manifest, SyncReport, localHash
+from boardMetrics import BoardMetrics, MeteredSerial
+from mpyCross import MpyCompiler
+from contentCache import ContentCache, CachedFile
 
 pyboard.PyboardError = PyboardErrorFactory
 
@@ -18,123 +33,1393 @@ BUFFER_SIZE = 1024  # Amount of data to read or write to the serial port at a ti
                     # bridges usually have very small buffers.
 
 
-def listComPorts(maxPort = 32, minPort = 1):
+PORT_CACHE = os.path.join(os.path.expanduser("~"), ".mpFPTel.json")   # the port last used for a 
+                                                                      # board, link settings per port
+settingsLock = threading.RLock()    # one thread at a time reads, changes and writes PORT_CACHE
+
+def readSettings():
+    try:
+        with open(PORT_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def writeSettings(**changes):
     """
-    List all com-ports on the system; occupied ones are preceeded by an asterisk (*)
+    Change settings in PORT_CACHE. The file is replaced as a whole, so that another process
+    (e.g. a second server) never reads half of it.
     """
-    result = []
-    for p in range(minPort, maxPort + 1):
+    with settingsLock:
+        settings = readSettings()
+        settings.update(changes)
+        temp = "%s.%d" % (PORT_CACHE, os.getpid())
         try:
-            try:
-                port = "COM%d" % p
-                s = serial.Serial(port)
-                s.close()
-                result.append(port)
-            except serial.SerialException as e:
-                _, _, err = str(e).partition("'%s': " % port)
-                raise eval(err) from e 
-        except PermissionError:
-            result.append("*" + port)
-        except:
+            with open(temp, "w") as f:
+                json.dump(settings, f, indent = 1)
+            os.replace(temp, PORT_CACHE)
+        except OSError:
             pass
+
+
+def lastKnownPort():
+    return readSettings().get("port", {})
+
+
+def rememberPort(device):
+    known = dict([(p[0], p) for p in enumeratePorts()]).get(device, (device, None, None))
+    writeSettings(port = {"device": known[0], "vid": known[1], "pid": known[2]})
+    
+    
+def rememberLink(device, link):
+    with settingsLock:      # boards of a pool are calibrated side by side
+        links = readSettings().get("links", {})
+        links[device] = link
+        writeSettings(links = links)
+    
+    
+def enumeratePorts():
+    """
+    List (device, vid, pid) of the serial ports that actually exist on the system.
+    """
+    try:
+        from serial.tools import list_ports
+        result = [(p.device, p.vid, p.pid) for p in list_ports.comports()]
+    except ImportError:
+        result = []
+    devices = [p[0] for p in result]
+    for device in sorted(glob("/dev/ttyACM*") + glob("/dev/ttyUSB*")):
+        if device not in devices:
+            result.append((device, None, None))
     return result
+
+
+def listComPorts(maxPort = 32, minPort = 1, others = True):
+    """
+    List the serial ports on the system, the one last used for a board (or one of the same 
+    USB vendor and product) first. COM-ports are limited to the range minPort..maxPort; other
+    devices (e.g. /dev/ttyACM0) are only listed if others.
+    """
+    last    = lastKnownPort()
+    ports   = []
+    for device, vid, pid in enumeratePorts():
+        isCom = device.upper().startswith("COM") and device[3:].isdigit()
+        if not (minPort <= int(device[3:]) <= maxPort if isCom else others):
+            continue
+        rank = 0 if device == last.get("device") else \
+               1 if vid is not None and (vid, pid) == (last.get("vid"), last.get("pid")) else 2
+        ports.append((rank, device))
+    return [device for _, device in sorted(ports, key = lambda p: p[0])]
+
+
+def knownBaudRate(device):
+    """
+    The baud rate that device was calibrated to (see PyBoardEx.applyCalibration), if any.
+    """
+    return readSettings().get("links", {}).get(device, {}).get("baudrate")
+
+
+def replAnswers(port):
+    """
+    Whether a MicroPython REPL answers on the (open) serial port at its current baud rate.
+    """
+    port.reset_input_buffer()
+    port.write(b'\r\x03\x03')
+    answer = port.read_until(b'>>> ')
+    return answer.endswith(b'>>> ') or b'raw REPL' in answer
+
+
+def probePort(device, speed = 115200, timeout = 0.5):
+    """
+    Return device if a MicroPython REPL answers on it, '*' + device if the port is in use 
+    by another process, or None. Next to speed, the baud rate the board was calibrated to 
+    is tried: a board keeps that until it is reset the hard way.
+    """
+    try:
+        port = serial.Serial(device, speed, timeout = timeout, write_timeout = timeout)
+    except serial.SerialException as e:
+        code = e.args[0] if e.args and isinstance(e.args[0], int) else None
+        busy = code in (errno.EACCES, errno.EBUSY) or "PermissionError" in str(e)
+        return "*" + device if busy else None
+    try:
+        for baudrate in [speed] + [b for b in [knownBaudRate(device)] if b not in (None, speed)]:
+            port.baudrate = baudrate
+            if replAnswers(port):
+                return device
+        return None
+    except serial.SerialException:
+        return None
+    finally:
+        port.close()
+
+
+def findBoards(speed = 115200, ports = None, first = False, timeout = 0.5):
+    """
+    Return the ports on which a board answers, probed side by side and ordered as by 
+    listComPorts; with first, the last known port is tried on its own beforehand. Ports in
+    use are returned with an asterisk. If no board answers at all, all ports are returned,
+    to be tried the slow way, those in use still with an asterisk.
+    """
+    ports = listComPorts() if ports is None else ports
+    if first and ports and ports[0] == lastKnownPort().get("device"):
+        if probePort(ports[0], speed, timeout) == ports[0]:
+            return ports[:1]
+    results = [None] * len(ports)
+    
+    def probe(i):
+        results[i] = probePort(ports[i], speed, timeout)
+        
+    workers = [threading.Thread(target = probe, args = (i,)) for i in range(len(ports))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    found = [r for r in results if r is not None]
+    if not [r for r in found if not r.startswith('*')]:
+        return [r if r is not None else p for p, r in zip(ports, results)]
+    return found
+    
+    
+
+class BoardFileReader(object):
+    """
+    File-like that hands out the content of a file on the board while it is being 
+    received (see operations.getFile), so no more than a chunk is held in memory.
+    The whole file comes in one session with the board, in segments: after each, the
+    board waits to be told to go on. Only if a caller of higher priority is waiting by
+    then, or the board is needed for something else (see release(), which buffers the
+    rest of the segment first), is the session ended, and resumed where it stopped.
+    """
+    
+    terminator  = b'*d*o*n*e*'
+    segmentSize = 16    # chunks, between which the session may end
+    
+    def __init__(self, board, fileName, chunkSize = None, compress = None):
+        self.board      = board
+        self.name       = fileName
+        self.chunkSize  = chunkSize or board.chunkSize
+        self.compress   = board.compressTransfers if compress is None else compress
+        self.position   = 0
+        self.offset     = 0
+        self.buffered   = deque()
+        self.chunks     = None
+        self.closed     = False
+        self.wireBytes  = 0
+        self.started    = time()
+        self.cacheKey   = None          # to keep the content by, see PyBoardEx.openReader()
+        self.collected  = bytearray()
+        self.stopping   = False         # end the session after the current segment
+        with board.access(BULK):
+            self._startSegment()
+        
+        
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+        
+        
+    def _startSegment(self):
+        board = self.board
+        board.enter_raw_repl()
+        try:
+            board.exec_raw_no_follow(board.callCode("getFile", self.name, self.terminator, self.chunkSize, 
+                                                    self.offset, self.segmentSize * self.chunkSize, self.compress))
+            mode = board.serial.read(1)
+            if mode == b'\x04':
+                error = board.read_until(1, b'\x04')
+                raise PyboardErrorFactory("exception", b'', error[:-1])
+            self.cooked     = mode == b'C'
+            self.zipped     = mode == b'Z'
+            self.compress   = self.zipped
+            self.size   = int.from_bytes(board.serial.read(4), "big")
+        except PyboardOSError as e:
+            board.exit_raw_repl()
+            e.transmogrify("getFile", self.name)
+            raise
+        except Exception as e:
+            board.exit_raw_repl()
+            if board.agentLost(e):
+                return self._startSegment()
+            raise
+        self.stopping   = False
+        self.chunks     = self._receive()
+        board.activeStream = self
+        
+        
+    def _endSegment(self):
+        self.chunks = None
+        if self.board.activeStream is self:
+            self.board.activeStream = None
+        self.board.exit_raw_repl()
+        
+        
+    def _receive(self):
+        serial = self.board.serial
+        try:
+            while True:
+                if self.cooked:
+                    yield from self._receiveCooked()
+                    break
+                length = min(self.segmentSize * self.chunkSize, self.size - self.offset)
+                yield from (self._receiveZipped(length) if self.zipped else self._receiveRaw(length))
+                self.offset += length
+                if self.offset >= self.size:
+                    break
+                if self.stopping or self.board.arbiter.contended():
+                    serial.write(b'S')
+                    break
+                # for data that does not compress, the rest is fetched uncompressed
+                self.zipped = self.compress
+                serial.write(b'Z' if self.zipped else b'R')
+            pending = self.board.read_until(len(self.terminator), self.terminator)
+            if not pending.endswith(self.terminator):
+                raise PyboardError("transfer of %s incomplete" % self.name)
+            out, err = self.board.follow(10)
+            if err:
+                raise PyboardErrorFactory("exception", out, err)
+        except Exception:
+            self._endSegment()
+            raise
+        self._endSegment()
+        
+        
+    def _receiveZipped(self, length):
+        serial      = self.board.serial
+        unzipper    = zlib.decompressobj()
+        received    = 0
+        wire        = 0
+        while True:
+            frameSize = int.from_bytes(serial.read(4), "big")
+            if frameSize == 0:
+                break
+            wire += 4 + frameSize
+            chunk = unzipper.decompress(serial.read(frameSize))
+            received += len(chunk)
+            if chunk:
+                yield chunk
+        chunk = unzipper.flush()
+        if chunk:
+            received += len(chunk)
+            yield chunk
+        self.wireBytes += wire
+        if received != length:
+            raise PyboardError("transfer of %s incomplete" % self.name)
+        self.compress = wire < 0.9 * length
+        
+        
+    def _receiveRaw(self, length):
+        serial      = self.board.serial
+        remaining   = length
+        while remaining > 0:
+            chunk = serial.read(min(self.chunkSize, remaining))
+            if not chunk:
+                raise PyboardError("transfer of %s incomplete" % self.name)
+            remaining -= len(chunk)
+            yield chunk
+        self.wireBytes += length
+        
+        
+    def _receiveCooked(self):
+        # line endings got 'cooked' underway, so the size is of no use: the board sends
+        # all of the rest, up to the terminator (which is left for _receive())
+        serial  = self.board.serial
+        pending = b''
+        while True:
+            pending += serial.read(1)
+            if pending.endswith(self.terminator):
+                break
+            if len(pending) >= self.chunkSize + len(self.terminator):
+                cut = len(pending) - len(self.terminator)
+                cut -= 1 if pending[:cut].endswith(b'\r') else 0
+                yield pending[:cut].replace(b'\r\n', b'\n')
+                pending = pending[cut:]
+        if len(pending) > len(self.terminator):
+            yield pending[:-len(self.terminator)].replace(b'\r\n', b'\n')
+        self.wireBytes     += self.size - self.offset
+        self.offset         = self.size
+        self.board.readAhead = self.terminator + self.board.readAhead
+        
+        
+    def release(self):
+        """
+        Receive (and keep) the rest of the current segment, and end the session there, so
+        the board is available again.
+        """
+        if self.chunks is not None:
+            self.stopping = True
+            self.buffered.extend(self.chunks)
+        
+        
+    def read(self, size = -1):
+        """
+        Read up to size bytes (all if size < 0). Like a socket, a short read only 
+        means that the rest has not arrived yet; b'' is returned at the end of the file.
+        """
+        result = bytearray()
+        with self.board.access(BULK):
+            while size < 0 or len(result) < size:
+                if not self.buffered:
+                    if result and size >= 0:
+                        break
+                    if self.chunks is None:
+                        if self.offset >= self.size:
+                            break
+                        self.board.arbiter.yieldTo()    # the session was ended for it
+                        self._startSegment()
+                    chunk = next(self.chunks, None)
+                    if chunk is None:
+                        continue
+                    self.buffered.append(chunk)
+                chunk = self.buffered.popleft()
+                take  = len(chunk) if size < 0 else size - len(result)
+                result += chunk[:take]
+                if take < len(chunk):
+                    self.buffered.appendleft(chunk[take:])
+        self.position += len(result)
+        if self.cacheKey is not None:
+            self.collected += result
+        return bytes(result)
+    
+    
+    def seek(self, offset, whence = 0):
+        """
+        Only moving forward is supported.
+        """
+        offset += self.position if whence == 1 else (self.size if whence == 2 else 0)
+        if offset != self.position:
+            self.cacheKey = None    # not all of it is read
+        if offset < self.position:
+            raise OSError("%s: cannot seek backwards" % self.name)
+        if offset > self.position:
+            self.stopping = True    # rather than receive what is skipped, start anew from offset
+        while self.position < offset and (self.buffered or self.chunks is not None or self.cooked):
+            if not self.read(min(offset - self.position, self.chunkSize)):
+                break
+        if self.position < offset and not self.cooked:
+            # in between segments: skip to the requested position right away
+            self.offset = self.position = min(offset, self.size)
+        return self.position
+    
+    
+    def tell(self):
+        return self.position
     
     
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            with self.board.access(BULK):
+                self.buffered.clear()
+                self.stopping = True
+                for _ in self.chunks or ():
+                    pass
+            if self.cacheKey is not None and self.position == self.size:
+                self.board.contentCache.put(self.name, self.cacheKey, self.collected)
+            self.board.noteTransfer(self.name, "get", self.position, self.wireBytes, time() - self.started)
 
+
+
+class BoardFileWriter(object):
+    """
+    File-like that streams data into a file on the board, see operations.putFile.
+    Data is sent in frames of at most chunkSize bytes, each one only after the board 
+    asked for it. So no more than a chunk is held in memory, and the board writes to
+    its flash while the next chunk is being collected. Every session with the board
+    ends with a check of the size and checksum it received. Should the board be 
+    needed for something else, the session is ended and later resumed in append mode
+    (see release()).
+    """
+    
+    operation = "putFile"
+    
+    def __init__(self, board, fileName, chunkSize = None, append = False, compress = None):
+        self.board      = board
+        self.name       = fileName
+        self.chunkSize  = chunkSize or board.chunkSize
+        self.compress   = board.compressTransfers if compress is None else compress
+        self.pending    = bytearray()
+        self.written    = 0     # confirmed by the board, per ended session
+        self.position   = 0     # passed to write(), see tell()
+        self.closed     = False
+        self.active     = False
+        self.wireBytes  = 0
+        self.started    = time()
+        with board.access(BULK):
+            self._open(append)
+        
+        
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+        
+        
+    def _open(self, append):
+        self.board.contentCache.invalidate(self.name)
+        self.board.enter_raw_repl()
+        self.active = True
+        self.size   = 0
+        self.crc    = 0
+        self.sum    = 0
+        try:
+            self.board.exec_raw_no_follow(self._command(append))
+            hello           = self._receive()
+            self.encoded    = hello == b'B'
+            self.compress   = hello == b'Z'
+            self.zipper     = zlib.compressobj(6, zlib.DEFLATED, 10) if self.compress else None
+            self.zipped     = bytearray()
+        except PyboardOSError as e:
+            e.transmogrify(self.operation, self.name)
+            raise
+        except Exception as e:
+            self._abandon()
+            if self.board.agentLost(e):
+                self.closed = False     # as _receive() gave up on it
+                return self._open(append)
+            raise
+        self.board.activeStream = self
+        
+        
+    def _command(self, append):
+        return self.board.callCode(self.operation, self.name, self.chunkSize, append, self.compress)
+        
+        
+    def _abandon(self):
+        if self.active:
+            self.active = False
+            if self.board.activeStream is self:
+                self.board.activeStream = None
+            self.board.exit_raw_repl()
+        
+        
+    def _receive(self):
+        reply = self.board.serial.read(1)
+        if reply in (b'\x06', b'R', b'B', b'Z'):
+            return reply
+        error = self.board.read_until(1, b'\x04') if reply == b'\x04' else None
+        self._abandon()
+        self.closed = True
+        if error is not None:
+            raise PyboardErrorFactory("exception", b'', error[:-1])
+        raise PyboardError("unexpected reply from board while writing %s: %r" % (self.name, reply))
+    
+    
+    def _sendFrame(self, frame):
+        self._receive()
+        payload = binascii.b2a_base64(frame, newline = False) if self.encoded else frame
+        self.board.serial.write(len(payload).to_bytes(4, "big") + payload)
+        self.wireBytes += 4 + len(payload)
+        
+        
+    def _sendData(self, data, final = False):
+        self.size  += len(data)
+        self.crc    = binascii.crc32(data, self.crc)
+        self.sum    = (self.sum + sum(data)) & 0xffffffff
+        if not self.zipper:
+            # no frame may exceed chunkSize: that is all the board has room for
+            for start in range(0, len(data), self.chunkSize):
+                self._sendFrame(data[start:start + self.chunkSize])
+            return
+        self.zipped += self.zipper.compress(data)
+        if final:
+            self.zipped += self.zipper.flush()
+        while len(self.zipped) >= self.chunkSize or (final and self.zipped):
+            self._sendFrame(bytes(self.zipped[:self.chunkSize]))
+            del self.zipped[:self.chunkSize]
+        
+        
+    def _endSession(self):
+        try:
+            data = bytes(self.pending)
+            del self.pending[:]
+            self._sendData(data, True)
+            self._receive()
+            self.board.serial.write(bytes(4))
+            out, err = self.board.follow(10)
+            if err:
+                raise PyboardErrorFactory("exception", out, err)
+            size, check, isCrc, stats = eval(out.decode("utf-8"))
+            if size != self.size or check != (self.crc if isCrc else self.sum):
+                raise PyboardErrorEx("writing %s failed: %d bytes sent, %d received (checksum mismatch: %s)" % 
+                                     (self.name, self.size, size, check != (self.crc if isCrc else self.sum)))
+            self.written += size
+            self._written(stats)
+        finally:
+            self._abandon()
+            
+            
+    def _written(self, stats):
+        self.board.cache.put(self.name, os.stat_result(stats))
+        
+        
+    def release(self):
+        """
+        End the session with the board for now; the next write() resumes it.
+        """
+        if self.active:
+            self._endSession()
+        
+        
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file %s" % self.name)
+        count = len(data)
+        data  = memoryview(data)
+        start = 0
+        self.position += count
+        if len(self.pending) + count < self.chunkSize:
+            self.pending += data
+            return count
+        with self.board.access(BULK):
+            if self.pending:
+                start = self.chunkSize - len(self.pending)
+                self.pending += data[:start]
+                chunk = bytes(self.pending)
+                del self.pending[:]
+                self._sendChunk(chunk)
+            while count - start >= self.chunkSize:
+                self._sendChunk(bytes(data[start:start + self.chunkSize]))
+                start += self.chunkSize
+        self.pending += data[start:]
+        return count
+    
+    
+    def _sendChunk(self, chunk):
+        # a session that was ended by someone else is resumed; between chunks, 
+        # those with a higher priority are allowed to go first
+        if not self.active:
+            self._open(True)
+        if self.zipper and self.size == 0 and len(zlib.compress(chunk, 1)) > 0.9 * len(chunk):
+            # does not compress: continue without
+            self.compress = False
+            self._endSession()
+            self._open(True)
+        self._sendData(chunk)
+        self.board.arbiter.yieldTo()
+    
+    
+    def tell(self):
+        return self.position
+    
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.board.access(BULK):
+            if self.active or self.pending:
+                if not self.active:
+                    self._open(True)
+                self._endSession()
+        self.board.noteTransfer(self.name, "put", self.written, self.wireBytes, time() - self.started)
+    
+    
+    
+class BoardBundleReader(BoardFileReader):
+    """
+    The bundle of everything below a folder on the board (see operations.getBundle), read like
+    a file while it is being received; bundle.readRecord() takes it apart. The whole bundle is
+    one segment, so should the board be needed for something else, the rest is buffered.
+    """
+    
+    def _startSegment(self):
+        board = self.board
+        board.enter_raw_repl()
+        try:
+            board.exec_raw_no_follow(board.callCode("getBundle", self.name, self.chunkSize, self.compress,
+                                                    [operations.AGENT_FILE]))
+            mode = board.serial.read(1)
+            if mode == b'\x04':
+                error = board.read_until(1, b'\x04')
+                raise PyboardErrorFactory("exception", b'', error[:-1])
+            self.cooked     = False
+            self.zipped     = mode == b'Z'
+            self.encoded    = mode == b'B'
+            self.size       = 0     # not known until the end
+        except PyboardOSError as e:
+            board.exit_raw_repl()
+            e.transmogrify("getBundle", self.name)
+            raise
+        except Exception as e:
+            board.exit_raw_repl()
+            if board.agentLost(e):
+                return self._startSegment()
+            raise
+        self.chunks = self._receive()
+        board.activeStream = self
+        
+        
+    def _frame(self):
+        board = self.board
+        first = board.serial.read(1)
+        if first == b'\x04':
+            error = board.read_until(1, b'\x04')
+            raise PyboardErrorFactory("exception", b'', error[:-1])
+        if self.encoded:
+            line = first if first == b'\n' else first + board.read_until(1, b'\n')
+            self.wireBytes += len(line)
+            return binascii.a2b_base64(line.strip())
+        header = first + board.serial.read(3)
+        size   = int.from_bytes(header, "big")
+        self.wireBytes += 4 + size
+        return board.serial.read(size)
+        
+        
+    def _receive(self):
+        unzipper = zlib.decompressobj() if self.zipped else None
+        received = 0
+        try:
+            while True:
+                frame = self._frame()
+                if not frame:
+                    break
+                chunk = unzipper.decompress(frame) if unzipper else frame
+                received += len(chunk)
+                if chunk:
+                    yield chunk
+            chunk = unzipper.flush() if unzipper else b''
+            if chunk:
+                received += len(chunk)
+                yield chunk
+            out, err = self.board.follow(10)
+            if err:
+                raise PyboardErrorFactory("exception", out, err)
+        except Exception:
+            self._endSegment()
+            raise
+        self.offset = self.size = received
+        self._endSegment()
+    
+    
+    
+class BoardBundleWriter(BoardFileWriter):
+    """
+    Unpacks folders and files into a folder on the board, all in one session (see 
+    operations.putBundle), where putting them one by one costs a session each:
+        with BoardBundleWriter(board, "/lib") as bundle:
+            bundle.mkdir("drivers")
+            bundle.create("drivers/sensor.py")
+            bundle.write(data)
+    The records are sent in frames like the data of BoardFileWriter, and so is the session
+    ended and resumed should the board be needed for something else.
+    """
+    
+    operation = "putBundle"
+    
+    def __init__(self, board, folder, chunkSize = None, compress = None):
+        self.current    = None      # path of the file that write() appends to
+        self.named      = False     # whether the board knows which file that is
+        self.files      = 0
+        super().__init__(board, folder.rstrip("/") + "/", chunkSize, False, compress)
+        
+        
+    def _command(self, append):
+        return self.board.callCode(self.operation, self.name, self.chunkSize, self.compress)
+    
+    
+    def _written(self, files):
+        self.files += files
+        self.board.cache.clear()    # too much changed to keep track of
+        
+        
+    def _endSession(self):
+        self.pending += bundle.record(bundle.END, "")
+        self.named    = False
+        super()._endSession()
+        
+        
+    def _put(self, data):
+        """
+        Queue a record; every full chunk of what is queued is sent. What is queued are whole
+        records only, so the session may end (see release()) whenever the board asks for it.
+        """
+        if self.closed:
+            raise ValueError("write to closed bundle %s" % self.name)
+        self.position += len(data)
+        self.pending  += data
+        if len(self.pending) < self.chunkSize:
+            return
+        with self.board.access(BULK):
+            while len(self.pending) >= self.chunkSize:
+                if not self.active:
+                    self._open(True)
+                if self.zipper and self.size == 0 and \
+                   len(zlib.compress(self.pending[:self.chunkSize], 1)) > 0.9 * self.chunkSize:
+                    # does not compress: continue without
+                    self.compress = False
+                    self._endSession()
+                    continue
+                chunk = bytes(self.pending[:self.chunkSize])
+                del self.pending[:self.chunkSize]
+                self._sendData(chunk)
+                self.board.arbiter.yieldTo()
+                
+                
+    def mkdir(self, path):
+        """
+        Create folder path (relative to the bundle's folder), if it does not exist yet.
+        """
+        self.current = None
+        self._put(bundle.record(bundle.FOLDER, path))
+        
+        
+    def create(self, path):
+        """
+        Create (or empty) file path (relative to the bundle's folder); write() adds its content.
+        """
+        self.current = path
+        self.named   = True
+        self._put(bundle.record(bundle.FILE, path))
+        
+        
+    def write(self, data):
+        if self.current is None:
+            raise ValueError("no file created in bundle %s to write to" % self.name)
+        if len(data):
+            self._put(bundle.record(bundle.APPEND, "" if self.named else self.current, bytes(data)))
+            self.named = True
+        return len(data)
+    
+    
+    
+class Batch(object):
+    """
+    Collects calls of operations helpers to have them run in one round trip:
+        with board.batch() as b:
+            b.add("deleteFile", "/a.txt")
+            b.add("getFileInfo", "/b.txt")
+        print(b.results)
+    """
+    
+    def __init__(self, board):
+        self.board      = board
+        self.calls      = []
+        self.results    = None
+        
+        
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, excType, *args):
+        if excType is None:
+            self.run()
+            
+            
+    def add(self, functionName, *args):
+        operations.checkArgs(functionName, args)
+        self.calls.append((functionName,) + args)
+        return len(self.calls) - 1
+    
+    
+    def run(self):
+        self.results = self.board.batch(self.calls)
+        return self.results
+    
+    
+    
 class PyBoardEx(Pyboard):
+    
+    cacheTTL = None     # seconds that cached file stats are trusted (None: until invalidated)
+    keepRawRepl = False # stay in raw REPL between calls, until the friendly REPL is needed
+    rawReplTimeout = 10 # ... or until the board was idle for this many seconds
+    streamTimeout = 120 # seconds that a call with streamed output (see remoteStream) may take
+    compressTransfers = False   # deflate file data on the wire, if the firmware can
+    reportTransfers = False     # print the compression ratio and throughput of every transfer
+    autoCalibrate = False       # tune chunk size and baud rate on connecting, see calibrate()
+    baudRates = (921600, 460800, 230400)    # to try, for boards of which the REPL is on a UART
+    uartPlatforms = {"esp8266": 0, "esp32": 0}   # sys.platform: the REPL's UART
+    maxChunkSize = 8 * BUFFER_SIZE
+    useRawPaste = True          # send code in raw-paste mode (with flow control) if the firmware has it
+    compileUploads = False      # upload .py files compiled to .mpy, see mpyCross
+    cacheContent = False        # keep downloaded files on the host while they do not change, see contentCache
+    verifyContent = False       # ... and only trust what is kept if the board has the same hash (a round trip)
 
-    def __init__(self, speed = 115200, port = -1, silent = False):
-        ports = listComPorts(port, port) if port > 0 else listComPorts() 
-       
+    def __init__(self, speed = 115200, port = -1, silent = False, useAgent = False, device = None, 
+                 transport = None):
+        if transport is not None:
+            ports = [transport]
+        elif device is not None:
+            ports = [device]
+        else:
+            ports = findBoards(speed, listComPorts(port, port, False) if port > 0 else listComPorts(), first = True)
+        self.name = None
+        self.useAgent = False
+        self.activeStream = None
+        self.deferred = []
+        self.cache = StatCache(self.cacheTTL)
+        self.contentCache = ContentCache()
+        self.arbiter = BoardArbiter()
+        self.metrics = BoardMetrics()
+        self.replUsers = 0
+        self.inRawRepl = False
+        self.idleTimer = None
+        self.replSwitches = 0
+        self.replSwitchesSaved = 0
+        self.lastTransfer = None
+        self.chunkSize = BUFFER_SIZE
+        self.readAhead = b""    # output of the board that was read before it was expected
+        self.rawPaste = None    # whether the firmware has raw-paste mode; None: not known yet
+        self.baseBaudRate = speed   # to return the board's UART to on close(), see switchBaudRate()
+        self.uart = None        # the board's REPL UART, once its baud rate was switched
         
-        for port in [p for p in ports if not p.startswith('*')]:     
+        for port in [p for p in ports if p is transport or not p.startswith('*')]:     
             if not silent: print(port, "   ", speed, "baud", end=" ... ")
             try:
-                super().__init__(port, speed)
+                if port is transport:
+                    # anything serial-like, e.g. mpEmulator.EmulatedSerial
+                    pyboard._rawdelay = pyboard._rawdelay or 0
+                    self.serial = transport
+                    port = getattr(transport, "port", "transport")
+                else:
+                    super().__init__(port, speed)
+                    self.findBaudRate(port, speed)
+                    rememberPort(port)
+                self.serial = MeteredSerial(self.serial, self.metrics)
+                self.name = posixpath.basename(port)
                 if not silent: print("found")
+                if useAgent:
+                    self.installAgent()
+                if self.autoCalibrate:
+                    self.applyCalibration(port, silent)
                 if not silent: 
                     for itm in self.getID().items():
                         print("%-9s: %s"% itm) 
                     print("-"*50, '\n')
-                self.stat = {}
                 return 
             except Exception as e:
                 print(e)
                 
+        info = "none of %s answered" % ", ".join([str(p) for p in ports])
         if len(ports) == 0:
             info = "no serial ports found at all"
-        elif any([p.startswith('*') for p in ports]):
+        elif any([isinstance(p, str) and p.startswith('*') for p in ports]):
             info = "serial ports that were found (i.e. %s) are in use by another process" % \
                     ", ".join([p[1:] for p in ports if p.startswith('*')])
         raise RuntimeError("no python board found: %s" % info)
     
         
+    def linkInfo(self):
+        """
+        Measure the link, all in one raw REPL session: the round trip time of an (empty) 
+        command, the throughput from the board and its free memory and platform.
+        """
+        with self.access():
+            self.enter_raw_repl()
+            try:
+                memFree, platform = eval(self.exec_(self.callCode("linkInfo", returnResult = True)))
+                start = time()
+                for _ in range(3):
+                    self.exec_("pass")
+                latency = (time() - start) / 3
+                size    = max(256, min(8192, memFree // 4))
+                start   = time()
+                out     = self.exec_("print('x' * %d)" % size)
+                elapsed = max(time() - start - latency, 1e-6)
+            finally:
+                self.exit_raw_repl()
+        return {"latency": latency, "throughput": len(out) / elapsed, "memFree": memFree, "platform": platform}
+    
+    
+    def findBaudRate(self, port, speed):
+        """
+        Should the board not answer at speed, try the baud rate it was calibrated to: it keeps
+        that after a soft reset, e.g. when a previous session did not end with close().
+        """
+        known   = knownBaudRate(port)
+        timeout = self.serial.timeout
+        if known in (None, speed):
+            return
+        self.serial.timeout = 0.5
+        try:
+            if replAnswers(self.serial):
+                return
+            self.serial.baudrate = known
+            if replAnswers(self.serial):
+                self.uart = readSettings()["links"][port].get("uart")
+            else:
+                self.serial.baudrate = speed
+        finally:
+            self.serial.timeout = timeout
+    
+    
+    def switchBaudRate(self, baudrate, uart):
+        """
+        Switch the board's REPL UART and the serial port to baudrate (see operations.setBaudRate);
+        should either side not hear from the other, both return to the old rate. 
+        Return whether the switch succeeded.
+        """
+        old     = self.serial.baudrate
+        timeout = self.serial.timeout
+        with self.access():
+            self.enter_raw_repl()
+            self.serial.timeout = 1
+            try:
+                self.exec_raw_no_follow(self.callCode("setBaudRate", uart, baudrate, old, 500))
+                if self.serial.read(1) != b'S':
+                    raise PyboardError("no reply to switching to %d baud" % baudrate)
+                sleep(0.1)
+                self.serial.baudrate = baudrate
+                self.serial.write(b'K')
+                if self.serial.read(1) == b'K':
+                    self.serial.write(b'O')
+                    out, err = self.follow(2)
+                    if not err and self.exec_("print(1 + 1)").strip() == b'2':
+                        self.uart = uart
+                        return True
+            except PyboardError:
+                pass
+            finally:
+                self.serial.timeout = timeout
+                self.exit_raw_repl()
+            # the board gave up on the new rate (it waits no longer than 0.5 s)
+            sleep(1)
+            self.serial.baudrate = old
+            self.serial.write(b'\r\x02\x03\x03')
+            sleep(0.1)
+            self.serial.reset_input_buffer()
+            self.inRawRepl = False
+            return False
+    
+    
+    def calibrate(self, silent = True):
+        """
+        Choose the chunk size from the link's round trip time and throughput (so that waiting
+        for the board's ACK costs little) and from the board's free memory; for boards of 
+        which the REPL is on a UART, first switch to the highest baud rate that works.
+        """
+        info = self.linkInfo()
+        uart = self.uartPlatforms.get(info["platform"])
+        if uart is not None and hasattr(self.serial, "baudrate"):
+            for baudrate in [b for b in self.baudRates if b > self.serial.baudrate]:
+                if self.switchBaudRate(baudrate, uart):
+                    info = self.linkInfo()
+                    break
+        wanted = 4 * info["throughput"] * info["latency"]
+        chunk  = BUFFER_SIZE // 4
+        while chunk < wanted and chunk * 2 <= min(self.maxChunkSize, info["memFree"] // 8):
+            chunk *= 2
+        self.chunkSize = chunk
+        if not silent:
+            print("link: %(latency).3f s round trip, %(throughput).0f bytes/s, %(memFree)d bytes free" % info,
+                  "-> %d byte chunks at %s baud" % (chunk, getattr(self.serial, "baudrate", "?")))
+        return {"chunkSize": chunk, "baudrate": getattr(self.serial, "baudrate", None), 
+                "uart": uart, "info": info}
+    
+    
+    def applyCalibration(self, port, silent = True):
+        """
+        Use the link settings remembered for port, or calibrate and remember them.
+        """
+        known   = readSettings().get("links", {}).get(port)
+        if known is not None:
+            self.chunkSize = known["chunkSize"]
+            if known["uart"] is not None and known["baudrate"] != self.serial.baudrate:
+                if not self.switchBaudRate(known["baudrate"], known["uart"]):
+                    known = None    # e.g. another board on this port: measure again
+        if known is None:
+            result = self.calibrate(silent)
+            rememberLink(port, {"chunkSize": result["chunkSize"], "baudrate": result["baudrate"], "uart": result["uart"]})
+        
+        
+    def close(self):
+        """
+        Return the board's UART to the baud rate of before calibrating and the board to the
+        friendly REPL, for the next session to find it there, and close the port.
+        """
+        try:
+            self.settle()
+        except Exception as e:
+            print("could not finish what was pending: %s" % e)
+        if self.uart is not None and getattr(self.serial, "baudrate", None) not in (None, self.baseBaudRate):
+            try:
+                self.switchBaudRate(self.baseBaudRate, self.uart)
+            except Exception as e:
+                print("could not return to %d baud: %s" % (self.baseBaudRate, e))
+        try:
+            self.leaveRawRepl()     # also stops the idle timer, which would use the closed port
+        except Exception as e:
+            print("could not leave the raw REPL: %s" % e)
+        super().close()
+        
+        
     def getID(self):
         return dict(self.remoteExecute("getID", returnResult = True))
      
         
 
+    def installAgent(self):
+        """
+        Store the operations helpers on the board as a module (only if absent or outdated),
+        so that from now on every call costs just an opcode plus its arguments instead of
+        the full source of the helper.
+        """
+        if self._remoteExec(operations.agentProbe()) != operations.AGENT_VERSION:
+            self.put(operations.AGENT_FILE, operations.agentSource().encode("utf-8"))
+            if self._remoteExec(operations.agentProbe()) != operations.AGENT_VERSION:
+                raise RuntimeError("could not install the board agent")
+        self.useAgent = True
+        
+        
+    def agentLost(self, error):
+        """
+        Whether error is the board not finding the agent (e.g. because its file was deleted);
+        if so, calls go without it from now on, until installAgent() is called again.
+        """
+        if not self.useAgent or not isinstance(error, PyboardErrorEx) or \
+           "no module named '%s'" % operations.AGENT_MODULE not in (error.traceBack or ""):
+            return False
+        print("the board agent is gone: calls go without it")
+        self.useAgent = False
+        return True
+        
+        
+    def callCode(self, functionName, *args, returnResult = False):
+        call = operations.agentCall if self.useAgent else operations.remoteCall
+        return call(functionName, *args, returnResult = returnResult)
+        
+        
     def remoteCommand(self, command, returnResult = True):
         code = command if not returnResult else "print(%s)" % command
         return(self._remoteExec(code, "", returnResult))
     
     
     def remoteExecute(self, functionName, *args, returnResult = True):
-        code = operations.remoteCall(functionName, *args, returnResult = returnResult)
+        code = self.callCode(functionName, *args, returnResult = returnResult)
         try:
-            return self._remoteExec(code, returnResult)
+            with self.metrics.timing(functionName):
+                return self._remoteExec(code, returnResult)
         except PyboardOSError as e:
             e.transmogrify(functionName, (list(args) + [None])[0])
             raise         
         except Exception as e:
+            if self.agentLost(e):
+                return self.remoteExecute(functionName, *args, returnResult = returnResult)
             return e
       
 
     def _remoteExec(self, code, returnResult = True):
-        self.enter_raw_repl()
-        try:
-            if returnResult:
-                out = self.exec_(code).decode("utf-8")
-                return "" if out.strip() == "" else eval(out)                                        
-            else:
+        with self.access():
+            self.enter_raw_repl()
+            try:
+                if returnResult:
+                    out = self.exec_(code).decode("utf-8")
+                    return "" if out.strip() == "" else eval(out)                                        
+                else:
+                    self.exec_raw_no_follow(code)
+                    if not self.rawPaste:
+                        sleep(0.1)  # without raw-paste mode, there is no telling it got all
+                    return
+            finally:
+                self.exit_raw_repl()
+        
+        
+    def remoteStream(self, consumer, functionName, *args):
+        """
+        Call functionName on the board and pass every line it prints to consumer as soon as
+        it arrives, instead of collecting all of its output first (see operations.walkDir).
+        Raises PyboardErrorEx if it is not done within streamTimeout seconds.
+        """
+        code = self.callCode(functionName, *args)
+        with self.access(), self.metrics.timing(functionName):
+            self.enter_raw_repl()
+            try:
                 self.exec_raw_no_follow(code)
-                sleep(0.1)
-                return
-        finally:
-            self.exit_raw_repl()
+                pending  = b""
+                deadline = time() + self.streamTimeout
+                while True:
+                    if time() > deadline:
+                        self.serial.write(b'\x03')    # stop it, so the raw REPL is left as usual
+                        raise PyboardErrorEx("%s did not finish within %d s" % (functionName, self.streamTimeout))
+                    pending += self.serial.read(max(1, self.serial.inWaiting()))
+                    end     = pending.find(b'\x04')
+                    lines   = (pending if end < 0 else pending[:end]).split(b'\r\n')
+                    pending = lines.pop() if end < 0 else pending[end + 1:]
+                    for line in lines:
+                        consumer(line.decode("utf-8"))
+                    if end >= 0:
+                        break
+                if b'\x04' not in pending:
+                    pending += self.read_until(1, b'\x04')
+                error, _, self.readAhead = pending.partition(b'\x04')     # e.g. the next prompt
+            finally:
+                self.exit_raw_repl()
+        if error:
+            error = PyboardErrorFactory("exception", b'', error)
+            if isinstance(error, PyboardOSError):
+                error.transmogrify(functionName, (list(args) + [None])[0])
+            if self.agentLost(error):
+                return self.remoteStream(consumer, functionName, *args)
+            raise error
+        
+        
+    def exec_raw_no_follow(self, command):
+        """
+        Send code to the raw REPL to be run. In raw-paste mode (MicroPython 1.14 and later), the
+        board tells how much it can take at a time, so the code goes at the speed of the link
+        instead of in small pieces with pauses in between.
+        """
+        self.metrics.roundTrips += 1
+        if not self.useRawPaste or self.rawPaste is False:
+            return super().exec_raw_no_follow(command)
+        if isinstance(command, str):
+            command = command.encode("utf-8")
+        if not self.read_until(1, b'>').endswith(b'>'):
+            raise PyboardError('could not enter raw repl')
+        self.serial.write(b'\x05A\x01')
+        reply = self.serial.read(2)
+        if reply == b'R\x01':
+            self.rawPaste = True
+            return self._paste(command)
+        if reply != b'R\x00':
+            # firmware that does not know about raw-paste mode restarts the raw REPL
+            self.read_until(1, b'w REPL; CTRL-B to exit\r\n>', timeout = 2)
+        self.rawPaste   = False
+        self.readAhead  = b'>'   # the prompt, for the classic way
+        super().exec_raw_no_follow(command)
+        
+        
+    def _paste(self, command):
+        window      = int.from_bytes(self.serial.read(2), "little")
+        remaining   = window
+        sent        = 0
+        while sent < len(command):
+            while remaining == 0 or self.serial.inWaiting() > 0:
+                reply = self.serial.read(1)
+                if reply == b'\x01':
+                    remaining += window
+                elif reply == b'\x04':
+                    self.serial.write(b'\x04')
+                    raise PyboardError('the board ended raw-paste mode')
+                else:
+                    raise PyboardError('unexpected reply in raw-paste mode: %r' % reply)
+            size = min(remaining, len(command) - sent)
+            self.serial.write(command[sent:sent + size])
+            remaining   -= size
+            sent        += size
+        self.serial.write(b'\x04')
+        if not self.read_until(1, b'\x04').endswith(b'\x04'):
+            raise PyboardError('could not complete raw-paste mode')
+        
+        
+    def read_until(self, min_num_bytes, ending, timeout = 10, data_consumer = None):
+        data, self.readAhead = self.readAhead, b""
+        if data.endswith(ending):
+            return data
+        with self.serial.waiting():
+            return data + super().read_until(min_num_bytes, ending, timeout, data_consumer)
+        
+        
+    def noteTransfer(self, fileName, direction, size, wireBytes, seconds):
+        """
+        Keep (and with reportTransfers, print) the statistics of a finished file transfer.
+        """
+        self.lastTransfer = {"file": fileName, "direction": direction, "bytes": size, "wireBytes": wireBytes, 
+                             "ratio": size / wireBytes if wireBytes else 1.0,
+                             "seconds": seconds, "throughput": size / seconds if seconds else 0.0}
+        self.metrics.observe(direction + "File", seconds)
+        if self.reportTransfers:
+            print("%(direction)s %(file)s: %(bytes)d bytes (%(wireBytes)d on the wire, ratio %(ratio).2f) "
+                  "in %(seconds).2f s, %(throughput).0f bytes/s" % self.lastTransfer)
+        
+        
+    def access(self, priority = COMMAND):
+        """
+        Context manager for exclusive use of the board, see arbiter.BoardArbiter:
+            with board.access(INTERACTIVE): ...
+        """
+        return self.arbiter.access(priority)
         
 
+    def enter_raw_repl(self):
+        self.settle()
+        with self.access():
+            self.replUsers += 1
+            if self.idleTimer is not None:
+                self.idleTimer.cancel()
+                self.idleTimer = None
+            if self.inRawRepl:
+                self.replSwitchesSaved += 1
+                return
+            try:
+                self.readAhead = b""
+                with self.metrics.timing("enterRawRepl"):
+                    super().enter_raw_repl()
+            except:
+                self.replUsers -= 1
+                raise
+            self.inRawRepl = True
+            self.replSwitches += 1
             
-    def get(self, filename, text = False):
-        terminator  = b'*d*o*n*e*'
-        self.remoteExecute("getFile", filename, terminator, BUFFER_SIZE)
-        size        = int.from_bytes(self.serial.read(4), "big")
-        
-        if size == 0x4547261: # b'Trac...'
-            data_err = self.read_until(1, b'\x04')
-            if not data_err.endswith(b'\x04'):
-                raise PyboardError('timeout waiting for second EOF reception')
-            data_err = size.to_bytes(4, "big") + data_err[:-1]
-            error = PyboardOSError("Exception", b'', data_err)
-            raise RuntimeError(error.translate())
             
-        # line endings may get changed in size
-        result      = self.read_until(size, terminator)[:-len(terminator)]
+    def exit_raw_repl(self):
+        with self.access():
+            self.replUsers = max(0, self.replUsers - 1)
+            if self.replUsers > 0:
+                return
+            if self.keepRawRepl:
+                self.idleTimer = threading.Timer(self.rawReplTimeout, self.leaveRawRepl, (True,))
+                self.idleTimer.daemon = True
+                self.idleTimer.start()
+                self.replSwitchesSaved += 1
+            else:
+                self.leaveRawRepl()
+                
+                
+    def leaveRawRepl(self, onlyIfIdle = False):
+        """
+        Return to the friendly REPL (if the board is not in use for something else).
+        """
+        with self.access():
+            if onlyIfIdle and (self.replUsers > 0 or self.activeStream is not None):
+                return
+            if self.idleTimer is not None:
+                self.idleTimer.cancel()
+                self.idleTimer = None
+            if self.inRawRepl:
+                self.readAhead = b""
+                super().exit_raw_repl()
+                self.read_until(1, b'>>> ', timeout = 1)   # the banner is not for the console
+                self.inRawRepl = False
+                self.replSwitches += 1
+                if onlyIfIdle:
+                    self.replSwitchesSaved -= 1
+        
+        
+    def settle(self):
+        """
+        Make sure that no transfer or deferred call is pending, so the board can be used
+        for something else.
+        """
+        with self.access():
+            if self.activeStream is not None:
+                self.activeStream.release()
+            if self.deferred:
+                self.flush()
+        
+        
+    def batch(self, calls = None):
+        """
+        Run calls, a list of (functionName, arg, ...) tuples, in one round trip. Return 
+        per call its result or, if it failed, the exception it would have raised. 
+        Without calls, a Batch is returned that collects them until it is run.
+        """
+        if calls is None:
+            return Batch(self)
+        if not calls:
+            return []
+        code = operations.batchCall(calls, self.useAgent)
+        try:
+            with self.access(), self.metrics.timing("batch"):
+                self.enter_raw_repl()
+                try:
+                    out = self.exec_(code).decode("utf-8")
+                finally:
+                    self.exit_raw_repl()
+        except PyboardErrorEx as e:
+            if self.agentLost(e):
+                return self.batch(calls)
+            raise
+        
+        results = []
+        for call, line in zip(calls, out.splitlines()):
+            failed, result = eval(line)
+            if failed:
+                result = PyboardErrorFactory("exception", b'', result.encode("utf-8"))
+                if isinstance(result, PyboardOSError):
+                    result.transmogrify(*call)
+            results.append(result)
+        return results
+    
+    
+    def defer(self, functionName, *args):
+        """
+        Queue a call, to be run in a batch with the ones that follow it, at the latest
+        when the board is needed for anything else.
+        """
+        operations.checkArgs(functionName, args)
+        with self.access():     # not while flush() takes them
+            self.deferred.append((functionName,) + args)
+        
+        
+    def flush(self):
+        """
+        Run the deferred calls. As nobody is waiting for them anymore, failures are
+        reported on the console and make the cache forget about the files concerned.
+        """
+        calls, self.deferred = self.deferred, []
+        results = self.batch(calls)
+        for call, result in zip(calls, results):
+            if isinstance(result, Exception):
+                print("deferred %s failed: %s" % (call[0], result))
+                self.cache.invalidate(os.path.dirname(call[1]))
+        return results
+        
+            
+    def get(self, filename, text = False):
+        with self.openReader(filename) as f:
+            result = f.read()
 
         if text:
             result  = result.decode("utf-8").replace("\r\n", "\n")
         return result
       
       
+    def openReader(self, fileName):
+        """
+        A file-like that reads fileName: with cacheContent, from the content cache if it has
+        the file as it is on the board (by size and mtime and, with verifyContent, its hash),
+        else a BoardFileReader that has the cache keep it. Before anything kept is served, the
+        board is asked for those (in one round trip): the stat cache may not have seen a
+        program on the board change the file.
+        """
+        if not self.cacheContent:
+            return BoardFileReader(self, fileName)
+        fresh   = self.contentCache.holds(fileName)
+        calls   = [("getFileInfo", fileName)] if fresh else []
+        if self.verifyContent:
+            calls.append(("hashFiles", [fileName], self.chunkSize))
+        results = self.batch(calls)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        if fresh:
+            stats = os.stat_result(results.pop(0))
+            self.cache.put(fileName, stats)
+        else:
+            stats = self.fileInfo(fileName)     # nothing kept to serve: only a key is needed
+        key     = (stats[6], stats[8]) + tuple(results[0] if results else ())
+        data    = self.contentCache.get(fileName, key)
+        if data is not None:
+            return CachedFile(fileName, data)
+        reader  = BoardFileReader(self, fileName)
+        if stats[6] <= self.contentCache.maxFileSize:
+            reader.cacheKey = key
+        return reader
+    
+    
     def fileInfo(self, filePath, getFresh = False):
-        if getFresh or not filePath in self.stat:
+        result = None
+        if not getFresh:
+            try:
+                result = self.cache.get(filePath)
+            except KeyError:
+                raise ResourceNotFound.fromCall("getFileInfo", filePath)
+        if result is None:
             result = os.stat_result(self.remoteExecute("getFileInfo", filePath, returnResult = True))
-            self.stat[filePath] = result
+            self.cache.put(filePath, result)
             
-        return self.stat[filePath]
+        return result
     
     
     def isDir(self, filePath):
+        if StatCache.normalize(filePath) == "/":
+            return True
         return  stat.S_ISDIR(self.fileInfo(filePath).st_mode)
     
      
@@ -147,36 +1432,47 @@ class PyBoardEx(Pyboard):
         will always return 0 (i.e. no recursive size computation).
         """
 
-        result = self.remoteExecute("scanDir", directory, recursive, returnResult = True)
-        self.stat = dict([(r[1] + r[0], os.stat_result(r[2])) for r in result])
+        result  = []
+        folder  = [None, []]    # path, entries; stored in the cache once the next folder begins
+
+        def record(line):
+            if line.endswith("/"):
+                if folder[0] is not None:
+                    self.cache.setListing(*folder)
+                folder[:] = [line, []]
+            elif line:
+                mode, size, mtime, name = line.split(" ", 3)
+                if folder[0] + name == operations.AGENT_FILE:
+                    return      # not the user's, see installAgent()
+                stats = (int(mode), 0, 0, 0, 0, 0, int(size), int(mtime), int(mtime), int(mtime))
+                folder[1].append((name, os.stat_result(stats)))
+                result.append((name, folder[0], stats))
+
+        self.remoteStream(record, "walkDir", directory, recursive)
+        if folder[0] is not None:
+            self.cache.setListing(*folder)
+        if not recursive:
+            result.sort()
         return result if long_format else [name[0] for name in result]
     
     
-    def osCall(self, methodName, *args):
-        command = operations.remoteCall(methodName, *args)
+    def osCall(self, methodName, *args, returnResult = False):
+        command = self.callCode(methodName, *args, returnResult = returnResult)
         try:
             return self._remoteExec(command)
         except PyboardOSError as ex:
             ex.transmogrify(methodName, *args) 
             raise
+        except PyboardErrorEx as ex:
+            if self.agentLost(ex):
+                return self.osCall(methodName, *args, returnResult = returnResult)
+            raise
     
     def put(self, filename, data):
         """Create or update the specified file with the provided data.
         """
-        # Open the file for writing on the board and write chunks of data.
-        self.enter_raw_repl()
-        self.exec_("f = open('{0}', 'wb')".format(filename))
-        size = len(data)
-        # Loop through and write a buffer size chunk of data at a time.
-        for i in range(0, size, BUFFER_SIZE):
-            chunk_size = min(BUFFER_SIZE, size - i)
-            chunk = repr(data[i : i + chunk_size])
-            # Make sure to send explicit byte strings (handles python 2 compatibility).
-            if not chunk.startswith("b"):
-                chunk = "b" + chunk
-            self.exec_("f.write({0})".format(chunk))
-        self.exec_("f.close()")
-        self.exit_raw_repl()
+        with BoardFileWriter(self, filename) as f:
+            f.write(data)
 
 
     def run(self, filename, wait_output=True):
@@ -184,17 +1480,18 @@ class PyBoardEx(Pyboard):
         (default) then wait for the script to finish and then print its output,
         otherwise just run the script and don't wait for any output.
         """
-        self.enter_raw_repl()
-        out = None
-        if wait_output:
-            # Run the file and wait for output to return.
-            out = self.execfile(filename)
-        else:
-            # Read the file and run it using lower level pyboard functions that
-            # won't wait for it to finish or return output.
-            with open(filename, "rb") as infile:
-                self.exec_raw_no_follow(infile.read())
-        self.exit_raw_repl()
+        with self.access():
+            self.enter_raw_repl()
+            out = None
+            if wait_output:
+                # Run the file and wait for output to return.
+                out = self.execfile(filename)
+            else:
+                # Read the file and run it using lower level pyboard functions that
+                # won't wait for it to finish or return output.
+                with open(filename, "rb") as infile:
+                    self.exec_raw_no_follow(infile.read())
+            self.exit_raw_repl()
         return out
         
         
@@ -203,20 +1500,39 @@ class PyBoardEx(Pyboard):
         
 class Microterm(PyBoardEx):
 
-    def __init__(self, speed = 115200, port = -1, silent = False):
-        super().__init__(speed, port, silent)
+    def __init__(self, speed = 115200, port = -1, silent = False, useAgent = False, device = None, 
+                 transport = None):
+        super().__init__(speed, port, silent, useAgent, device, transport)
+        self.lineSent = time()
+        self.compiler = MpyCompiler(self)
     
 
     def sendLineCommand(self, command):
+        with self.access(INTERACTIVE):
+            return self._sendLine(command)
+        
+        
+    def _sendLine(self, command):
+        self.settle()
+        self.leaveRawRepl()
+        self.cache.clear()  # who knows what the command does to the file system
         command = (command + "\r\n").encode("utf-8")
+        self.metrics.roundTrips += 1
+        self.lineSent = time()
         self.serial.write(command)
-        sleep(0.01)
         return command
     
     def readUntilPrompt(self, prompt=b">>>", command = None):
+        with self.access(INTERACTIVE):
+            return self._readUntilPrompt(prompt, command)
+        
+        
+    def _readUntilPrompt(self, prompt=b">>>", command = None):
         if command is not None:
             self.read_until(1, command, 2).decode("utf-8").replace("\r\n", "\n") #, self.copyOutput)
         out = self.read_until(1, prompt, 2).decode("utf-8").replace("\r\n", "\n") #, self.copyOutput)
+        if command is not None:
+            self.metrics.observe("line", time() - self.lineSent)
         return out + "" if out.endswith('>') else '\n' 
 
 
@@ -240,12 +1556,58 @@ class Microterm(PyBoardEx):
                 break;
             else:
                 try:
-                    cmd = self.sendLineCommand(cmd)
-                    readUntilPrompt(command = cmd)
+                    with self.access(INTERACTIVE):
+                        cmd = self.sendLineCommand(cmd)
+                        readUntilPrompt(command = cmd)
                 except PyboardError as e:
                     print(e)
 
 
+    def interrupt(self):
+        """
+        Ctrl-C: stop whatever runs in the REPL. Served before any pending file transfer.
+        """
+        with self.access(INTERACTIVE):
+            self.settle()
+            self.leaveRawRepl()
+            self.serial.write(b'\x03')
+
+
+    def sendKeys(self, keys):
+        """
+        Pass keystrokes (bytes) to the friendly REPL as they are typed, Ctrl-C and Ctrl-D included,
+        without waiting for a prompt; what the REPL prints comes from readConsole().
+        """
+        with self.access(INTERACTIVE):
+            self.settle()
+            self.leaveRawRepl()
+            if b'\r' in keys or b'\x04' in keys:
+                self.cache.clear()  # who knows what the command does to the file system
+            self.serial.write(keys)
+
+
+    def readConsole(self, timeout = 0.05):
+        """
+        Return what the friendly REPL printed, as soon as anything arrives (b"" if nothing did
+        within timeout seconds), or None while the board is in use for something else, as the
+        output is then not for the console.
+        """
+        with self.access(IDLE):
+            if self.inRawRepl or self.activeStream is not None:
+                return None
+            serial  = self.serial
+            waiting = serial.inWaiting()
+            if waiting:
+                return serial.read(waiting)
+            old = serial.timeout
+            serial.timeout = timeout
+            try:
+                data = serial.readIdle(1)
+            finally:
+                serial.timeout = old
+            return data + serial.read(serial.inWaiting()) if data else data
+
+
     def stop(self):
         super().close()
         print("session closed.")
@@ -253,22 +1615,83 @@ class Microterm(PyBoardEx):
 
         
     def getFiles(self, path = "/", recurse = False):
-        result = self.ls(path, False, recursive = recurse)
-        files  = [FileDescriptor(file[0], FileStat(*file[2]), file[1]) for file in result]
-        if recurse:
-            rm = []
-            for f in files:
-                if f.isDir:
-                    cc = [c for c in files if c.isParent(f.path + f.name)]
-                    f.addChildren(cc)
-                    rm += f.children
-                    
-            for r in rm:
-                files.remove(r)
-        return files
+        tree = FileTree(self.ls(path, True, recursive = recurse))
+        return tree.find(path).children
 
         
     
+    def openOnBoard(self, fileName, mode = "rb"):
+        """
+        Return a file-like that reads from, or writes to, the file on the board while
+        data is transferred.
+        """
+        if mode.startswith("r"):
+            return self.openReader(fileName)
+        return BoardFileWriter(self, fileName, append = mode.startswith("a"))
+    
+    
+    def openBundle(self, folder = "/", mode = "rb"):
+        """
+        Return a stream of the bundle of everything below folder on the board (see 
+        BoardBundleReader) or, to write, a BoardBundleWriter that unpacks into folder.
+        """
+        if mode.startswith("r"):
+            return BoardBundleReader(self, folder)
+        return BoardBundleWriter(self, folder)
+    
+    
+    def putTree(self, sourcePath, folder = "/"):
+        """
+        Copy all folders and files below sourcePath into folder on the board, in one session
+        (see BoardBundleWriter) rather than one per file. Returns the number of files copied.
+        """
+        with self.openBundle(folder, "wb") as destination:
+            for path, folders, files in os.walk(sourcePath):
+                folders.sort()
+                relative = os.path.relpath(path, sourcePath).replace(os.sep, "/")
+                relative = "" if relative == "." else relative + "/"
+                for name in folders:
+                    destination.mkdir(relative + name)
+                for name in sorted(files):
+                    destination.create(relative + name)
+                    with open(os.path.join(path, name), "rb") as source:
+                        for chunk in iter(lambda: source.read(BUFFER_SIZE * 16), b''):
+                            destination.write(chunk)
+        return destination.files
+    
+    
+    def getTree(self, destinationPath, folder = "/"):
+        """
+        Copy all folders and files below folder on the board to destinationPath, in one session
+        (see BoardBundleReader): the counterpart of putTree, e.g. for a backup. Returns the 
+        number of files copied.
+        """
+        files = 0
+        with self.openBundle(folder) as source:
+            while True:
+                entry = bundle.readRecord(source)
+                if entry is None:
+                    break
+                path, isDir, size = entry
+                relative = bundle.safePath(path)
+                if relative is None:
+                    raise PyboardErrorEx("bundle %s holds an invalid path: %s" % (folder, path))
+                localName = os.path.join(destinationPath, *relative.split("/"))
+                if isDir:
+                    os.makedirs(localName, exist_ok = True)
+                    continue
+                os.makedirs(os.path.dirname(localName), exist_ok = True)
+                with open(localName, "wb") as destination:
+                    while size > 0:
+                        chunk = source.read(min(size, BUFFER_SIZE * 16))
+                        if not chunk:
+                            raise PyboardErrorEx("bundle %s incomplete" % folder)
+                        destination.write(chunk)
+                        size -= len(chunk)
+                files += 1
+        return files
+    
+    
     def copyFileFromBoard(self, fileName, destinationPath = None):
         asText  = (os.path.splitext(fileName)[1] in [".py", ".txt", ".json"]) and (destinationPath is None)
         content = self.get(fileName, asText)
@@ -283,9 +1706,17 @@ class Microterm(PyBoardEx):
         return FileStat(*stat).size
     
     
-    def mirrorFromBoard(self, destinationPath, files = None):
+    def mirrorFromBoard(self, destinationPath, files = None, sync = False):
+        """
+        Copy all files on the board to destinationPath, in one session (see getTree); with 
+        sync, only those that changed since the previous sync (see syncFromBoard). Given
+        files (FileDescriptors), only those are copied, one by one.
+        """
+        if sync:
+            return self.syncFromBoard(destinationPath)
         if files is None:
-            files = self.getFiles(recurse=True)
+            print(self.getTree(destinationPath), "files copied")
+            return
             
         for f in files:
             print(f, end=" copying ...")
@@ -294,18 +1725,170 @@ class Microterm(PyBoardEx):
                 print(self.copyFileFromBoard(fn, destinationPath), "bytes copied")
             else:
                 print("directory")
-                fn = os.path.join(destinationPath, fn)
+                fn = os.path.join(destinationPath, f.name)
                 os.makedirs(fn, exist_ok = True)
                 self.mirrorFromBoard(fn, f.children)
         
            
+    def boardFiles(self):
+        """
+        Return {path: stats} of all files on the board and the set of its folders.
+        """
+        files, folders = {}, set(["/"])
+        for name, path, stats in self.ls("/", True, recursive = True):
+            if stat.S_ISDIR(stats[0]):
+                folders.add(StatCache.normalize(path + name))
+            else:
+                files[StatCache.normalize(path + name)] = stats
+        return files, folders
+    
+    
+    def boardHashes(self, paths):
+        """
+        Hashes of the files on the board (see operations.hashFiles), all in one call.
+        """
+        if not paths:
+            return []
+        return self.remoteExecute("hashFiles", list(paths), self.chunkSize, returnResult = True)
+    
+    
+    def syncFromBoard(self, destinationPath, deleteOrphans = False):
+        """
+        Bring destinationPath up to date with the board. Files whose size and mtime did not 
+        change on either side since the last sync are skipped; the others are compared by 
+        hash and downloaded only if different. Local files that are not on the board are 
+        deleted if deleteOrphans, otherwise only reported. Returns a SyncReport.
+        """
+        manifest        = Manifest(destinationPath)
+        report          = SyncReport()
+        files, _        = self.boardFiles()
+        suspects        = []
+        for path, stats in sorted(files.items()):
+            if manifest.boardKnown(path, stats) and manifest.localKnown(path):
+                report.unchanged += 1
+            else:
+                suspects.append(path)
+        boardHashes = [manifest.hash(p) if manifest.boardKnown(p, files[p]) else None for p in suspects]
+        unknown     = [p for p, h in zip(suspects, boardHashes) if h is None]
+        hashes      = dict(zip(unknown, self.boardHashes(unknown)))
+        for path, boardHash in zip(suspects, boardHashes):
+            boardHash = boardHash or hashes.get(path)
+            localName = manifest.localName(path)
+            if boardHash is None:
+                continue    # gone in the meantime
+            if os.path.isfile(localName) and localHash(localName, boardHash) == boardHash:
+                report.unchanged += 1
+            else:
+                print(path, "copying ...")
+                os.makedirs(os.path.dirname(localName), exist_ok = True)
+                with self.openOnBoard(path) as source, open(localName, "wb") as destination:
+                    for chunk in iter(lambda: source.read(BUFFER_SIZE * 16), b''):
+                        destination.write(chunk)
+                report.copied.append(path)
+            manifest.record(path, files[path], boardHash)
+        for path, localName in sorted(manifest.localFiles().items()):
+            if path not in files:
+                report.orphans.append(path)
+                manifest.forget(path)
+                if deleteOrphans:
+                    os.remove(localName)
+                    report.deleted.append(path)
+        for path in list(manifest.entries):
+            if path not in files:
+                manifest.forget(path)
+        manifest.save()
+        print(report)
+        return report
+    
+    
+    def syncToBoard(self, sourcePath, deleteOrphans = False):
+        """
+        Deploy sourcePath to the board: the counterpart of syncFromBoard, uploading only 
+        new and changed files. Files on the board that are not in sourcePath are deleted 
+        if deleteOrphans, otherwise only reported. Returns a SyncReport.
+        """
+        manifest        = Manifest(sourcePath)
+        report          = SyncReport()
+        files, folders  = self.boardFiles()
+        localFiles      = manifest.localFiles()
+        suspects        = []
+        for path in sorted(localFiles):
+            stats = files.get(path)
+            if manifest.boardKnown(path, stats) and manifest.localKnown(path):
+                report.unchanged += 1
+            elif stats is not None and stats[6] == os.path.getsize(localFiles[path]):
+                suspects.append(path)
+            else:
+                report.copied.append(path)
+        for path, boardHash in zip(suspects, self.boardHashes(suspects)):
+            if boardHash is not None and localHash(localFiles[path], boardHash) == boardHash:
+                report.unchanged += 1
+                manifest.record(path, files[path], boardHash)
+            else:
+                report.copied.append(path)
+        if report.copied:
+            # all in one session (see BoardBundleWriter), after which the new stats come in one call
+            with self.openBundle("/", "wb") as destination:
+                for path in report.copied:
+                    print(path, "copying ...")
+                    folder = posixpath.dirname(path)
+                    missing = []
+                    while folder not in folders:
+                        missing.insert(0, folder)
+                        folder = posixpath.dirname(folder)
+                    for folder in missing:
+                        destination.mkdir(folder[1:])
+                        folders.add(folder)
+                    destination.create(path[1:])
+                    with open(localFiles[path], "rb") as source:
+                        for chunk in iter(lambda: source.read(BUFFER_SIZE * 16), b''):
+                            destination.write(chunk)
+            copied, _ = self.boardFiles()
+            for path, boardHash in zip(report.copied, self.boardHashes(report.copied)):
+                manifest.record(path, copied[path], boardHash)
+        for path in sorted(files):
+            if path not in localFiles:
+                report.orphans.append(path)
+                if deleteOrphans:
+                    self.rm(path)
+                    report.deleted.append(path)
+        for path in list(manifest.entries):
+            if path not in localFiles:
+                manifest.forget(path)
+        manifest.save()
+        print(report)
+        return report
+        
+           
     def copyFileToBoard(self, fileName, data = None):
         if data is None:
             with open(fileName, "rb") as f:
                 data = f.read()
         elif isinstance(data, IOBase):
             data = data.read()
-        self.put(fileName, data)
+        compiled = self.compiler.compile(fileName, data) if self.compileUploads else None
+        if compiled is None:
+            self.put(fileName, data)
+            return
+        self.put(*compiled)
+        # the firmware would import the source rather than the .mpy, so remove it if the stat
+        # cache or else a listing of the folder (kept for the uploads that follow) has it
+        try:
+            known = self.cache.get(fileName)
+            if known is None:
+                self.ls(posixpath.dirname(fileName) or "/")
+                known = self.cache.get(fileName)
+        except KeyError:
+            return
+        if known is not None:
+            self.rm(fileName)
+        
+        
+    def compiles(self, fileName):
+        """
+        Whether fileName is to be compiled before it is uploaded (see copyFileToBoard()).
+        """
+        return self.compileUploads and self.compiler.wants(fileName)
 
 
     def chdir(self, path):
@@ -316,21 +1899,37 @@ class Microterm(PyBoardEx):
         """Create the specified directory.  Note this cannot create a recursive
         hierarchy of directories, instead each one should be created separately.
         """
-        self.osCall("mkDir", directory)        
+        stats = self.osCall("mkDir", directory, returnResult = True)
+        self.cache.put(directory, os.stat_result(stats))
 
 
-    def rm(self, filename):
-        self.osCall("deleteFile", filename)
+    def rm(self, filename, defer = False):
+        """Remove the specified file. If defer is True, only check that it is a file
+        and have it removed with the next batch of calls (see PyBoardEx.defer()).
+        """
+        if defer:
+            if stat.S_ISDIR(self.fileInfo(filename).st_mode):
+                raise FileExpected.fromCall("deleteFile", filename)
+            self.defer("deleteFile", filename)
+        else:
+            self.osCall("deleteFile", filename)
+        self.cache.remove(filename)
+        self.contentCache.invalidate(filename)
         return
 
 
     def rmdir(self, directory, force=False):
         """[Forcefully] remove the specified directory and all its children."""
         self.osCall("deleteFolder", directory, force)
+        self.cache.remove(directory)
+        self.contentCache.invalidate(directory)
 
 
     def rename(self, oldName, newName):
         self.osCall("rename", oldName, newName)
+        self.cache.rename(oldName, newName)
+        self.contentCache.invalidate(oldName)
+        self.contentCache.invalidate(newName)
         
 if __name__ == '__main__':
     print(PyBoardEx())
\ No newline at end of file
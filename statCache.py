@@ -0,0 +1,173 @@
+from time import time
+import threading
+import posixpath
+import stat
+
+
+class CacheNode(object):
+    """
+    The cached stat of one file or folder. For a folder, children holds the nodes that
+    are known so far; complete tells whether they are all of them.
+    """
+
+    def __init__(self, stats = None):
+        self.stats      = stats
+        self.time       = time()
+        self.children   = {}
+        self.complete   = False
+        self.listTime   = 0
+
+
+    def isDir(self):
+        return self.stats is None or stat.S_ISDIR(self.stats[0])
+
+
+
+class StatCache(object):
+    """
+    Tree of the stats of the files on the board, so that walking through the folders
+    does not forget about what was seen before. Paths are normalized (relative paths
+    are taken relative to the root) and an entry expires after ttl seconds, if given.
+    A path that is absent in the complete listing of its folder is known not to exist.
+    The cache may be shared by threads.
+    """
+
+    def __init__(self, ttl = None):
+        self.ttl    = ttl
+        self.lock   = threading.RLock()
+        self.clear()
+
+
+    def clear(self):
+        with self.lock:
+            self.root   = CacheNode()
+
+
+    @classmethod
+    def normalize(cls, path):
+        path = posixpath.normpath("/" + path.replace('\\', '/'))
+        return "/" + path.lstrip("/")
+
+
+    @classmethod
+    def split(cls, path):
+        return [p for p in cls.normalize(path).split("/") if p]
+
+
+    def _fresh(self, moment):
+        return self.ttl is None or time() - moment < self.ttl
+
+
+    def _node(self, path, create = False):
+        node = self.root
+        for name in self.split(path):
+            child = node.children.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[name] = CacheNode()
+                child.time = 0
+            node = child
+        return node
+
+
+    def _parent(self, path):
+        parts = self.split(path)
+        if not parts:
+            return None, None
+        return self._node("/".join(parts[:-1])), parts[-1]
+
+
+    def get(self, path):
+        """
+        Return the cached stats of path, None if unknown or expired.
+        Raise KeyError if path is known not to exist.
+        """
+        with self.lock:
+            node = self._node(path)
+            if node is not None and node.stats is not None and self._fresh(node.time):
+                return node.stats
+            parent, name = self._parent(path)
+            if node is None and parent is not None and parent.complete and self._fresh(parent.listTime):
+                raise KeyError(path)
+            return None
+
+
+    def put(self, path, stats):
+        with self.lock:
+            node        = self._node(path, True)
+            node.stats  = stats
+            node.time   = time()
+            if not node.isDir():
+                node.children.clear()
+                node.complete = False
+
+
+    def setListing(self, directory, entries):
+        """
+        Store the complete content of directory, a list of (name, stats) tuples.
+        Whatever is known about the content of its subfolders is kept.
+        """
+        with self.lock:
+            node    = self._node(directory, True)
+            old     = node.children
+            node.children = {}
+            for name, stats in entries:
+                child = old.get(name)
+                if child is None or not child.isDir():
+                    child = CacheNode()
+                child.stats = stats
+                child.time  = time()
+                if not child.isDir():
+                    child.children.clear()
+                    child.complete = False
+                node.children[name] = child
+            node.complete   = True
+            node.listTime   = time()
+
+
+    def listing(self, directory):
+        """
+        Return the complete content of directory as a list of (name, stats) tuples,
+        or None if it is not (or no longer) known.
+        """
+        with self.lock:
+            node = self._node(directory)
+            if node is None or not node.complete or not self._fresh(node.listTime):
+                return None
+            return sorted([(n, c.stats) for n, c in node.children.items()])
+
+
+    def remove(self, path):
+        """
+        Forget path (and all below it) because it was deleted.
+        """
+        with self.lock:
+            parent, name = self._parent(path)
+            if parent is not None:
+                parent.children.pop(name, None)
+
+
+    def rename(self, oldPath, newPath):
+        with self.lock:
+            parent, name = self._parent(oldPath)
+            node = None if parent is None else parent.children.pop(name, None)
+            self.remove(newPath)
+            newParent, newName = self._parent(newPath)
+            if newParent is not None:
+                if node is not None:
+                    newParent.children[newName] = node
+                else:
+                    newParent.complete = False
+
+
+    def invalidate(self, path):
+        """
+        Forget what is known about path, but keep it in the listing of its folder.
+        """
+        with self.lock:
+            node = self._node(path)
+            if node is not None:
+                node.stats      = None
+                node.time       = 0
+                node.complete   = False
@@ -2,8 +2,11 @@ import asyncio
 from telnetlib3.server import TelnetServer
 import logging
 from asyncio.futures import CancelledError
+import codecs
+from asyncBoard import AsyncBoard
 
 terminal  = None
+pool      = None    # a BoardPool: every session first selects the board to talk to
 whiteList = ['127.0.0.1']
 
 class MPTelnetServer(TelnetServer):
@@ -21,47 +24,168 @@ class MPTelnetServer(TelnetServer):
 
         
 @asyncio.coroutine
-def getRemoteInput(reader, writer):
+def getRemoteInput(reader, writer, board = None):
     buff = ''
     while True:
         c = yield from reader.read(1)
-        print(c, end='', flush=True)
 
-        if c == "\r":
+        if c == "\x03":
+            # Ctrl-C goes to the board right away, ahead of any transfer
+            if board is not None:
+                yield from AsyncBoard(board).interrupt()
+            continue
+
+        if c == "\r" or not c:
             # EOF
             return buff
         buff += c
             
             
+@asyncio.coroutine
+def selectBoard(reader, writer):
+    names = pool.names()
+    if len(names) == 1:
+        return pool[names[0]]
+    while True:
+        writer.write("boards: %s\nselect: " % ", ".join(names))
+        name = yield from getRemoteInput(reader, writer)
+        if name.strip() in names:
+            return pool[name.strip()]
+        writer.write("unknown board '%s'\n" % name)
+
+
+
+class ConsolePump(object):
+    """
+    Forwards what the REPL of a board prints to all Telnet sessions on that board, as soon
+    as it arrives, while the sessions' keystrokes go to the board the other way.
+    """
+    pumps = {}  # board: pump
+
+    def __init__(self, board):
+        self.board      = board
+        self.writers    = set()
+
+
+    @classmethod
+    def subscribe(cls, board, writer):
+        pump = cls.pumps.get(board)
+        if pump is None:
+            pump = cls.pumps[board] = cls(board)
+            asyncio.ensure_future(pump.run())
+        pump.writers.add(writer)
+
+
+    @classmethod
+    def unsubscribe(cls, board, writer):
+        pump = cls.pumps.get(board)
+        if pump is not None:
+            pump.writers.discard(writer)
+
+
+    @asyncio.coroutine
+    def run(self):
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        board   = AsyncBoard(self.board)
+        while self.writers:
+            try:
+                data = yield from board.readConsole()
+            except Exception as e:
+                data = str(e).encode("utf-8")
+            if data is None:
+                # the board is in raw REPL for the file system; nothing to show
+                yield from asyncio.sleep(0.1)
+                continue
+            text = decoder.decode(data)
+            for writer in list(self.writers):
+                writer.write(text)
+        del self.pumps[self.board]
+
+
+
+def keystrokes(text, state):
+    """
+    The keys as the REPL wants them: Enter as a single CR, whether the client sends CR LF,
+    CR NUL or LF. state[0] tells whether the previous piece ended in CR.
+    """
+    result = []
+    for c in text:
+        if state[0] and c in "\n\x00":
+            state[0] = False
+            continue
+        state[0] = c == "\r"
+        result.append("\r" if c == "\n" else c)
+    return "".join(result)
+
+
+def metaCommand(line, board, writer):
+    """
+    Lines that start with '%' are for this server rather than the board.
+    """
+    if line.strip() == "%stats":
+        writer.write("\r\n" + "\r\n".join(board.metrics.report(board)))
+    else:
+        writer.write("\r\nunknown meta-command '%s' (try %%stats)" % line.strip())
+
+
 @asyncio.coroutine
 def shell(reader, writer):
     peer    = writer.transport._extra["peername"][0]
-    if peer in whiteList: 
-        for itm in terminal.getID().items():
-            writer.write("%-9s: %s\n" % itm) 
-        writer.write("-"*50, '\n' * 2)
-    else:
+    board   = terminal
+    if peer not in whiteList: 
+        print("refused", peer, flush=True)
         writer.write("connection refused")
+        writer.close()
+        return
+    if pool is not None:
+        board = yield from selectBoard(reader, writer)
+    remote  = AsyncBoard(board)
+    info    = yield from remote.getID()
+    for itm in info.items():
+        writer.write("%-9s: %s\r\n" % itm) 
+    writer.write("-"*50 + "\r\n")
     
-    while True:
-        command = yield from getRemoteInput(reader, writer)
-        
-        if peer in whiteList: 
-            print(command, end='', flush=True)
-    
-            try:
-                cmd = terminal.sendLineCommand(command)
-                response = terminal.readUntilPrompt(command = cmd)
-                writer.write(response)
-            except Exception as e:
-                print(e, flush=True)
-                writer.write(str(e))
-        else:
-            print("ignored", peer, "with command '%s'" % command, flush=True)
+    ConsolePump.subscribe(board, writer)
+    try:
+        yield from remote.sendKeys(b'\r')   # for a prompt
+        meta, state, atLineStart = None, [False], True
+        while True:
+            text = yield from reader.read(256)
+            if not text:
+                break
+            keys = []
+            for c in keystrokes(text, state):
+                if meta is not None:
+                    # a meta-command is typed: echo it here, the board does not see it
+                    if c == "\r":
+                        metaCommand(meta, board, writer)
+                        meta, c = None, "\r"
+                    elif c in "\x08\x7f":
+                        writer.write("\x08 \x08")
+                        meta = meta[:-1] or None
+                        continue
+                    else:
+                        writer.write(c)
+                        meta += c
+                        continue
+                elif atLineStart and c == "%":
+                    writer.write(c)
+                    meta = c
+                    continue
+                keys.append(c)
+                atLineStart = c == "\r"
+            if keys:
+                yield from remote.sendKeys("".join(keys).encode("utf-8"))
+    finally:
+        ConsolePump.unsubscribe(board, writer)
 
         
 
 def start():
+    """
+    Serve Telnet on an event loop of its own, in the calling thread; board calls are run
+    on worker threads (see AsyncBoard), so the loop does not wait for the serial port.
+    """
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     coro = MPTelnetServer.create_server(port=23, shell=shell)
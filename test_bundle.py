@@ -0,0 +1,80 @@
+"""
+Bundle transfers (see BoardBundleWriter and BoardBundleReader) against the board emulator.
+Run with: python -m unittest test_bundle
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import bundle
+from mpEmulator import EmulatedSerial
+from pyBoardEx import Microterm
+
+
+CHUNK_SIZE = 1024
+
+
+
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root   = tempfile.mkdtemp()
+        self.board  = Microterm(silent = True, transport = EmulatedSerial(self.root))
+        self.board.chunkSize = CHUNK_SIZE
+
+
+    def tearDown(self):
+        self.board.close()
+        shutil.rmtree(self.root, True)
+
+
+    def roundTrip(self, data):
+        writer = self.board.openBundle("/", "wb")
+        writer.create("a")
+        writer.write(data)
+        writer.close()
+        with open(os.path.join(self.root, "a"), "rb") as f:
+            self.assertEqual(f.read(), data)
+        with self.board.openBundle("/") as reader:
+            self.assertEqual(bundle.readRecord(reader), ("a", False, len(data)))
+            self.assertEqual(bundle.readExactly(reader, len(data)), data)
+            self.assertIsNone(bundle.readRecord(reader))
+
+
+    def test_frameBoundary(self):
+        # what is queued at the end, plus the end record, may exceed a frame: records of
+        # the file, its content and the end, with a name of one byte
+        fits = CHUNK_SIZE - 3 * bundle.RECORD.size - 1
+        for size in (fits, fits + 1, fits + 6, CHUNK_SIZE, 3 * CHUNK_SIZE + 1):
+            for compress in (False, True):
+                with self.subTest(size = size, compress = compress):
+                    self.board.compressTransfers = compress
+                    self.roundTrip(b"x" * size)
+                    self.roundTrip(os.urandom(size))
+
+
+    def test_tree(self):
+        source = tempfile.mkdtemp()
+        target = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(source, "lib", "empty"))
+            for name, size in (("main.py", 100), ("lib/big.bin", 5 * CHUNK_SIZE + 1), ("lib/none", 0)):
+                with open(os.path.join(source, *name.split("/")), "wb") as f:
+                    f.write(os.urandom(size))
+            self.assertEqual(self.board.putTree(source), 3)
+            self.assertEqual(self.board.getTree(target), 3)
+            for path, folders, files in os.walk(source):
+                relative = os.path.relpath(path, source)
+                self.assertTrue(os.path.isdir(os.path.join(target, relative)))
+                for name in files:
+                    with open(os.path.join(path, name), "rb") as a, \
+                         open(os.path.join(target, relative, name), "rb") as b:
+                        self.assertEqual(a.read(), b.read())
+        finally:
+            shutil.rmtree(source, True)
+            shutil.rmtree(target, True)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+"""
+Tracing of what the server does, as nested spans: FTP command -> file system call -> board call
+-> serial I/O. The spans are written to a file in the Chrome trace format (JSON), to be loaded in
+chrome://tracing, Perfetto or speedscope.
+
+Nothing is traced, and nothing costs time, until startTracing() is called: only then are the
+methods concerned wrapped, and stopTracing() puts the originals back.
+"""
+from functools import wraps
+from time import perf_counter
+import atexit
+import inspect
+import json
+import os
+import threading
+
+
+tracer = None   # the active Tracer, if any
+
+
+
+class Tracer(object):
+
+    def __init__(self, fileName = None, echo = False):
+        self.fileName   = fileName
+        self.echo       = echo      # also print every file system call to the console
+        self.events     = []
+        self.started    = perf_counter()
+        self.originals  = []        # (class, name, original or None)
+        self.threads    = {}
+
+
+    def _timestamp(self):
+        return (perf_counter() - self.started) * 1e6     # microseconds
+
+
+    def add(self, name, category, start, end, args = None):
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": tid,
+                 "ts": start, "dur": end - start}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+
+    def wrap(self, cls, name, category, spanName = None):
+        """
+        Replace method name of cls by one that records a span for every call.
+        spanName(self, *args) may give the span a name of its own.
+        """
+        original    = inspect.getattr_static(cls, name)
+        if not inspect.isfunction(original):
+            return                  # class- and static methods, properties
+        tracer      = self
+        label       = "%s.%s" % (cls.__name__, name)
+        echo        = self.echo and category == "fs"
+
+        @wraps(original)
+        def traced(obj, *args, **kwargs):
+            if echo:
+                print("calling %s(%s)" % (label, describe(args, kwargs)))
+            start = tracer._timestamp()
+            try:
+                return original(obj, *args, **kwargs)
+            finally:
+                tracer.add(spanName(obj, *args) if spanName else label, category, start,
+                           tracer._timestamp(), {"args": describe(args, kwargs)} if args or kwargs else None)
+
+        self.originals.append((cls, name, cls.__dict__.get(name)))
+        setattr(cls, name, traced)
+
+
+    def wrapAll(self, cls, category, exclude = ()):
+        """
+        Wrap every public method of cls, inherited ones included.
+        """
+        for name in dir(cls):
+            if not name.startswith('_') and name not in exclude:
+                self.wrap(cls, name, category)
+
+
+    def unwrap(self):
+        for cls, name, original in reversed(self.originals):
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+        self.originals = []
+
+
+    def save(self):
+        if self.fileName is None:
+            return
+        names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                 for tid, name in list(self.threads.items())]
+        with open(self.fileName, "w") as f:
+            json.dump({"traceEvents": names + list(self.events), "displayTimeUnit": "ms"}, f)
+
+
+
+def describe(args, kwargs = {}):
+    """
+    The arguments of a call as text; data only by its length.
+    """
+    def text(a):
+        if isinstance(a, (bytes, bytearray, memoryview)):
+            return "<%d bytes>" % len(a)
+        a = repr(a)
+        return a if len(a) <= 80 else a[:77] + "..."
+    return ", ".join([text(a) for a in args] + ["%s=%s" % (k, text(v)) for k, v in kwargs.items()])
+
+
+
+def startTracing(fileName = None, echo = False):
+    """
+    Start recording spans, to be written to fileName by stopTracing() (or when the process ends);
+    with echo, every file system call is printed as well (as MPFS.debug used to do).
+    """
+    global tracer
+    from mpFTP import MPFS, MPFTPHandler, UploadFile
+    from pyBoardEx import PyBoardEx, Microterm, BoardFileReader, BoardFileWriter, BoardBundleReader, BoardBundleWriter
+    from boardMetrics import MeteredSerial
+
+    stopTracing()
+    tracer = Tracer(fileName, echo)
+    tracer.wrap(MPFTPHandler, "process_command", "ftp", lambda handler, cmd, *args: "FTP " + cmd)
+    tracer.wrapAll(MPFS, "fs", exclude = ("locate", "ftpnorm", "fs2ftp", "ftp2fs", "folderName", "validpath"))
+    tracer.wrap(UploadFile, "close", "fs")
+    for name in ("remoteExecute", "remoteCommand", "batch", "enter_raw_repl", "leaveRawRepl", "noteTransfer"):
+        tracer.wrap(PyBoardEx, name, "board")
+    for name in ("sendKeys", "sendLineCommand", "readUntilPrompt", "interrupt", "putTree", "getTree"):
+        tracer.wrap(Microterm, name, "board")
+    for name in ("_startSegment", "_receive", "read", "seek", "close"):
+        tracer.wrap(BoardFileReader, name, "transfer")
+    for name in ("_open", "_sendFrame", "_endSession", "write", "close"):
+        tracer.wrap(BoardFileWriter, name, "transfer")
+    for name in ("_startSegment", "_receive"):
+        tracer.wrap(BoardBundleReader, name, "transfer")
+    for name in ("_endSession", "mkdir", "create", "write"):
+        tracer.wrap(BoardBundleWriter, name, "transfer")
+    tracer.wrap(PyBoardEx, "read_until", "serial")
+    for name in ("read", "write"):
+        tracer.wrap(MeteredSerial, name, "serial")
+    return tracer
+
+
+
+def stopTracing():
+    """
+    Stop recording, restore the methods as they were and write the trace file.
+    """
+    global tracer
+    if tracer is not None:
+        tracer.unwrap()
+        tracer.save()
+        tracer = None
+
+
+
+atexit.register(stopTracing)